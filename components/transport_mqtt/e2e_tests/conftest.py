@@ -1,10 +1,14 @@
 import pytest
 import paho.mqtt.client as mqtt
-import json
+import orjson
 import time
 import threading
-import queue
+import collections
+import socket
+import os
+import uuid
 import logging
+from pathlib import Path
 from typing import List, Dict, Any
 
 # Configure logging
@@ -17,20 +21,42 @@ class MQTTTestClient:
     def __init__(self, broker_host="broker.emqx.io", broker_port=1883):
         self.broker_host = broker_host
         self.broker_port = broker_port
-        self.client = mqtt.Client()
+        # Persistent session: the broker keeps our subscriptions across reconnects
+        # (re-subscribed in _on_connect when it didn't keep the session).
+        # The xdist worker id keeps client ids distinct and readable per worker.
+        worker_id = os.environ.get("PYTEST_XDIST_WORKER", "main")
+        self.client = mqtt.Client(client_id=f"e2e-{worker_id}-{uuid.uuid4().hex[:8]}", clean_session=False)
+        
+        # Wide in-flight window and unbounded outgoing queue for bursts
+        self.client.max_inflight_messages_set(200)
+        self.client.max_queued_messages_set(0)
         self.connected = False
-        self.messages = queue.Queue()
-        self.subscribed_topics = []
+        self._connected_event = threading.Event()
+        # Bounded: when full, the oldest message is dropped and counted
+        self.messages = collections.deque(maxlen=1024)
+        self.dropped_messages = 0
+        self._msg_event = threading.Event()
+        self.subscribed_topics = {}  # topic -> qos
+        
+        # Responses indexed by correlation id: id -> [Event, response]
+        self.pending = {}
+        self.pending_lock = threading.Lock()
         
         # Setup callbacks
         self.client.on_connect = self._on_connect
         self.client.on_disconnect = self._on_disconnect
-        self.client.on_message = self._on_message
+        
+        # Topic-specific dispatch, other topics register their own handlers
+        self.client.message_callback_add("smartdrip/resp", self._on_resp)
         
     def _on_connect(self, client, userdata, flags, rc):
         """Callback when client connects"""
         if rc == 0:
+            # Broker without session persistence: restore subscriptions ourselves
+            if not flags.get('session present') and self.subscribed_topics:
+                client.subscribe(list(self.subscribed_topics.items()))
             self.connected = True
+            self._connected_event.set()
             logger.info(f"✅ Connected to MQTT broker {self.broker_host}:{self.broker_port}")
         else:
             logger.error(f"❌ Failed to connect to MQTT broker: {rc}")
@@ -38,42 +64,61 @@ class MQTTTestClient:
     def _on_disconnect(self, client, userdata, rc):
         """Callback when client disconnects"""
         self.connected = False
+        self._connected_event.clear()
         logger.info("🔌 Disconnected from MQTT broker")
     
-    def _on_message(self, client, userdata, msg):
-        """Callback when message received"""
+    def _on_resp(self, client, userdata, msg):
+        """Callback when response message received"""
         try:
             topic = msg.topic
-            payload = msg.payload.decode('utf-8')
+            payload = msg.payload
             logger.info(f"📨 Received message on {topic}: {payload}")
             
-            # Try to parse as JSON
+            # Try to parse as JSON (orjson parses bytes directly, no decode needed)
             try:
-                data = json.loads(payload)
-            except json.JSONDecodeError:
-                data = payload
+                data = orjson.loads(payload)
+            except orjson.JSONDecodeError:
+                # Only non-JSON payloads pay for a UTF-8 decode
+                data = payload.decode('utf-8', errors='replace')
+            
+            # Route responses for in-flight commands straight to their waiter
+            if isinstance(data, dict):
+                with self.pending_lock:
+                    entry = self.pending.get(data.get('id'))
+                if entry is not None:
+                    entry[1] = data
+                    entry[0].set()
+                    return
             
-            self.messages.put({
+            if len(self.messages) == self.messages.maxlen:
+                self.dropped_messages += 1
+                logger.warning(f"⚠️ Message queue full, dropped oldest ({self.dropped_messages} total)")
+            
+            self.messages.append({
                 'topic': topic,
                 'payload': payload,
                 'data': data,
                 'timestamp': time.time()
             })
+            self._msg_event.set()
         except Exception as e:
             logger.error(f"❌ Error processing message: {e}")
     
     def connect(self, timeout=10):
         """Connect to MQTT broker"""
         logger.info(f"🔗 Connecting to {self.broker_host}:{self.broker_port}")
+        self._connected_event.clear()
         self.client.connect(self.broker_host, self.broker_port, 60)
+        
+        # Larger send buffer so bursts don't block on the socket
+        sock = self.client.socket()
+        if sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1 << 20)
+        
         self.client.loop_start()
         
         # Wait for connection
-        start_time = time.time()
-        while not self.connected and (time.time() - start_time) < timeout:
-            time.sleep(0.1)
-        
-        if not self.connected:
+        if not self._connected_event.wait(timeout):
             raise ConnectionError(f"Failed to connect to MQTT broker within {timeout}s")
         
         return True
@@ -81,8 +126,10 @@ class MQTTTestClient:
     def disconnect(self):
         """Disconnect from MQTT broker"""
         if self.connected:
-            self.client.loop_stop()
             self.client.disconnect()
+            self.client.loop_stop()
+            self.connected = False
+            self._connected_event.clear()
     
     def subscribe(self, topic, qos=0):
         """Subscribe to topic"""
@@ -91,7 +138,7 @@ class MQTTTestClient:
         
         result = self.client.subscribe(topic, qos)
         if result[0] == mqtt.MQTT_ERR_SUCCESS:
-            self.subscribed_topics.append(topic)
+            self.subscribed_topics[topic] = qos
             logger.info(f"📋 Subscribed to {topic}")
         else:
             raise RuntimeError(f"Failed to subscribe to {topic}: {result}")
@@ -102,7 +149,7 @@ class MQTTTestClient:
             raise RuntimeError("Not connected to MQTT broker")
         
         if isinstance(payload, dict):
-            payload = json.dumps(payload)
+            payload = orjson.dumps(payload)
         
         result = self.client.publish(topic, payload, qos, retain)
         
@@ -112,40 +159,167 @@ class MQTTTestClient:
         else:
             raise RuntimeError(f"Failed to publish to {topic}: {result.rc}")
     
-    def wait_for_message(self, timeout=5, topic_filter=None):
+    def publish_many(self, msgs):
+        """Publish a batch of (topic, payload, qos, retain) messages"""
+        if not self.connected:
+            raise RuntimeError("Not connected to MQTT broker")
+        
+        # Serialize everything up front so the publish loop stays tight
+        batch = [
+            (topic, orjson.dumps(payload) if isinstance(payload, dict) else payload, qos, retain)
+            for topic, payload, qos, retain in msgs
+        ]
+        
+        mids = []
+        for topic, payload, qos, retain in batch:
+            result = self.client.publish(topic, payload, qos, retain)
+            if result.rc != mqtt.MQTT_ERR_SUCCESS:
+                raise RuntimeError(f"Failed to publish to {topic}: {result.rc}")
+            mids.append(result.mid)
+        
+        logger.info(f"📤 Published batch of {len(batch)} messages")
+        return mids
+    
+    def wait_for_message(self, timeout=5):
         """Wait for message from ESP32"""
-        try:
-            message = self.messages.get(timeout=timeout)
+        deadline = time.monotonic() + timeout
+        
+        while True:
+            # Clear before checking so a message arriving meanwhile still wakes us
+            self._msg_event.clear()
             
-            if topic_filter and message['topic'] != topic_filter:
-                # Put it back and try again
-                self.messages.put(message)
-                return self.wait_for_message(timeout, topic_filter)
+            try:
+                return self.messages.popleft()
+            except IndexError:
+                pass
             
-            return message
-        except queue.Empty:
-            return None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self._msg_event.wait(remaining):
+                return None
+    
+    def register_expect(self, command_id):
+        """Register a command id whose response should be captured"""
+        with self.pending_lock:
+            self.pending[command_id] = [threading.Event(), None]
+    
+    def wait_for_id(self, command_id, timeout=5):
+        """Wait for the response matching a registered command id"""
+        with self.pending_lock:
+            entry = self.pending.setdefault(command_id, [threading.Event(), None])
+        
+        entry[0].wait(timeout)
+        
+        with self.pending_lock:
+            self.pending.pop(command_id, None)
+        
+        return entry[1]
     
     def clear_messages(self):
         """Clear message queue"""
-        while not self.messages.empty():
-            try:
-                self.messages.get_nowait()
-            except queue.Empty:
-                break
+        self.messages.clear()
+        with self.pending_lock:
+            self.pending.clear()
+
+PUBLIC_BROKER = {
+    "host": "broker.emqx.io",
+    "port": 1883,
+    "ws_port": 8083
+}
+
+LOCAL_BROKER_IMAGE = "eclipse-mosquitto:2"
+LOCAL_BROKER_CONF = Path(__file__).parent / "mosquitto.conf"
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--public-broker",
+        action="store_true",
+        default=False,
+        help="Use public broker.emqx.io instead of a local Mosquitto container"
+    )
+
+def _wait_for_port(host, port, timeout=15):
+    """Wait until a TCP port accepts connections"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((host, port), timeout=1):
+                return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def _start_local_broker():
+    """Start the local Mosquitto container and wait until it accepts connections"""
+    import docker
+    
+    docker_client = docker.from_env()
+    logger.info(f"🐳 Starting local MQTT broker ({LOCAL_BROKER_IMAGE})")
+    container = docker_client.containers.run(
+        LOCAL_BROKER_IMAGE,
+        detach=True,
+        remove=True,
+        ports={"1883/tcp": 1883, "8083/tcp": 8083},
+        volumes={str(LOCAL_BROKER_CONF): {"bind": "/mosquitto/config/mosquitto.conf", "mode": "ro"}}
+    )
+    
+    if not _wait_for_port("127.0.0.1", 1883):
+        container.stop()
+        raise ConnectionError("Local MQTT broker did not start")
+    
+    return container
+
+def pytest_configure(config):
+    """With pytest-xdist, start one shared local broker before workers spawn"""
+    if os.environ.get("PYTEST_XDIST_WORKER") or not getattr(config.option, "numprocesses", None):
+        return
+    if config.getoption("--public-broker") or os.environ.get("MQTT_BROKER_HOST"):
+        return
+    
+    config._local_broker = _start_local_broker()
+    
+    # Workers inherit the environment and reuse this broker
+    os.environ["MQTT_BROKER_HOST"] = "127.0.0.1"
+    os.environ["MQTT_BROKER_PORT"] = "1883"
+
+def pytest_unconfigure(config):
+    container = getattr(config, "_local_broker", None)
+    if container is not None:
+        container.stop()
 
 @pytest.fixture(scope="session")
-def mqtt_broker():
-    """Fixture providing MQTT broker info"""
-    return {
-        "host": "broker.emqx.io",
-        "port": 1883,
-        "ws_port": 8083
-    }
+def mqtt_broker(request):
+    """Fixture providing MQTT broker info
+    
+    Defaults to a local Mosquitto container so test RTT is not dominated by
+    internet latency. The ESP32 must be configured (CONFIG_MQTT_BROKER_URI)
+    to reach this host on port 8083. Use --public-broker for interop runs
+    against broker.emqx.io, or set MQTT_BROKER_HOST to reuse a running broker.
+    """
+    if request.config.getoption("--public-broker"):
+        yield PUBLIC_BROKER
+        return
+    
+    if os.environ.get("MQTT_BROKER_HOST"):
+        yield {
+            "host": os.environ["MQTT_BROKER_HOST"],
+            "port": int(os.environ.get("MQTT_BROKER_PORT", "1883")),
+            "ws_port": 8083
+        }
+        return
+    
+    container = _start_local_broker()
+    try:
+        yield {
+            "host": "127.0.0.1",
+            "port": 1883,
+            "ws_port": 8083
+        }
+    finally:
+        container.stop()
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def mqtt_client(mqtt_broker):
-    """Fixture providing configured MQTT test client"""
+    """Fixture providing configured MQTT test client, shared across the session"""
     client = MQTTTestClient(mqtt_broker["host"], mqtt_broker["port"])
     
     # Connect to broker
@@ -175,12 +349,30 @@ def test_setup_teardown(mqtt_client):
     
     yield
     
+    # Restore the shared client if a test left it disconnected
+    if not mqtt_client.connected:
+        mqtt_client.connect()  # subscriptions restored on connect
+    
     # Cleanup after test
     mqtt_client.clear_messages()
 
+# Pre-serialized commands for payload-free ops, formatted with the command id
+_CMD_TEMPLATES = {
+    "ping": b'{"id":%d,"op":"ping"}',
+    "wifi_info": b'{"id":%d,"op":"wifi_info"}',
+}
+
 # Helper functions for common test patterns
 def send_command(mqtt_client, command_id, op, payload=None):
     """Helper to send command to ESP32"""
+    # Register before publishing so a fast response can't be missed
+    mqtt_client.register_expect(command_id)
+    
+    template = _CMD_TEMPLATES.get(op) if payload is None else None
+    if template is not None:
+        mqtt_client.publish("smartdrip/cmd", template % command_id)
+        return {"id": command_id, "op": op}
+    
     cmd = {
         "id": command_id,
         "op": op
@@ -192,14 +384,30 @@ def send_command(mqtt_client, command_id, op, payload=None):
     mqtt_client.publish("smartdrip/cmd", cmd)
     return cmd
 
-def wait_for_response(mqtt_client, expected_id, timeout=5):
-    """Helper to wait for response from ESP32"""
-    message = mqtt_client.wait_for_message(timeout, "smartdrip/resp")
-    
-    if not message:
-        return None
+def send_commands(mqtt_client, commands):
+    """Helper to send a batch of (command_id, op, payload) commands to ESP32"""
+    msgs = []
     
-    if isinstance(message['data'], dict) and message['data'].get('id') == expected_id:
-        return message['data']
+    for command_id, op, payload in commands:
+        mqtt_client.register_expect(command_id)
+        
+        template = _CMD_TEMPLATES.get(op) if payload is None else None
+        if template is not None:
+            msgs.append(("smartdrip/cmd", template % command_id, 0, False))
+            continue
+        
+        cmd = {
+            "id": command_id,
+            "op": op
+        }
+        
+        if payload is not None:
+            cmd["payload"] = payload
+        
+        msgs.append(("smartdrip/cmd", cmd, 0, False))
     
-    return None
\ No newline at end of file
+    return mqtt_client.publish_many(msgs)
+
+def wait_for_response(mqtt_client, expected_id, timeout=5):
+    """Helper to wait for response from ESP32"""
+    return mqtt_client.wait_for_id(expected_id, timeout)
\ No newline at end of file
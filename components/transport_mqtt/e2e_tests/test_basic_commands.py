@@ -94,13 +94,10 @@ def test_rapid_commands(mqtt_client, esp32_topics):
     
     responses = []
     
-    # Send multiple ping commands rapidly
+    # Send multiple ping commands rapidly (publish doesn't block on the network loop)
     for i in range(5):
         cmd_id = 10 + i
         send_command(mqtt_client, cmd_id, "ping")
-        
-        # Brief delay between commands
-        time.sleep(0.1)
     
     # Collect all responses
     for i in range(5):
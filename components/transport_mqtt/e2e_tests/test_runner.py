@@ -10,12 +10,18 @@ import subprocess
 import time
 import sys
 import os
+import re
 import argparse
+import functools
 import serial
 import threading
 import queue
+import collections
 from pathlib import Path
 
+# Serial log lines signalling the ESP32 is ready for testing
+READY_PATTERN = re.compile(rb"MQTT connesso al broker|WiFi connesso")
+
 class ESP32TestRunner:
     """Manages ESP32 flashing and test execution"""
     
@@ -25,6 +31,8 @@ class ESP32TestRunner:
         self.serial_output = queue.Queue()
         self.serial_thread = None
         self.esp32_ready = False
+        self._ready_event = threading.Event()
+        self._echo_serial = False
         
     def _find_build_dir(self):
         """Find the ESP32 build directory"""
@@ -38,8 +46,10 @@ class ESP32TestRunner:
         
         raise FileNotFoundError("Could not find ESP32 build directory")
     
-    def _find_esp32_port(self):
-        """Try to auto-detect ESP32 port"""
+    @staticmethod
+    @functools.lru_cache(maxsize=1)
+    def _find_esp32_port():
+        """Try to auto-detect ESP32 port (scanned once per process)"""
         import serial.tools.list_ports
         
         # Common ESP32 USB-to-serial chip VIDs
@@ -52,6 +62,24 @@ class ESP32TestRunner:
         
         return None
     
+    def _run_streaming(self, cmd, tail_lines=200):
+        """Run a command echoing its output live, return (returncode, output tail)"""
+        tail = collections.deque(maxlen=tail_lines)
+        
+        proc = subprocess.Popen(
+            cmd,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        )
+        
+        for line in proc.stdout:
+            print(line, end="")
+            tail.append(line)
+        
+        return proc.wait(), "".join(tail)
+    
     def flash_esp32(self, force_rebuild=False):
         """Flash ESP32 with current firmware"""
         print("🔨 Building and flashing ESP32 firmware...")
@@ -65,28 +93,29 @@ class ESP32TestRunner:
             # Build if needed
             if force_rebuild or not Path(self.build_dir).exists():
                 print("🏗️ Building firmware...")
-                result = subprocess.run(
-                    ["idf.py", "build"],
-                    capture_output=True,
-                    text=True
-                )
+                # idf.py builds with ninja, which already uses every core
+                returncode, tail = self._run_streaming(["idf.py", "build"])
                 
-                if result.returncode != 0:
-                    print(f"❌ Build failed:\n{result.stderr}")
+                if returncode != 0:
+                    print(f"❌ Build failed:\n{tail}")
                     return False
                 
                 print("✅ Build completed")
             
+            # Resolve the port once so esptool doesn't rescan on its own
+            if not self.esp32_port:
+                self.esp32_port = self._find_esp32_port()
+            
             # Flash firmware
             flash_cmd = ["idf.py", "flash"]
             if self.esp32_port:
                 flash_cmd.extend(["-p", self.esp32_port])
             
             print(f"📤 Flashing firmware...")
-            result = subprocess.run(flash_cmd, capture_output=True, text=True)
+            returncode, tail = self._run_streaming(flash_cmd)
             
-            if result.returncode != 0:
-                print(f"❌ Flash failed:\n{result.stderr}")
+            if returncode != 0:
+                print(f"❌ Flash failed:\n{tail}")
                 return False
             
             print("✅ Firmware flashed successfully")
@@ -104,13 +133,19 @@ class ESP32TestRunner:
             ser = serial.Serial(self.esp32_port, 115200, timeout=1)
             
             while True:
-                line = ser.readline().decode('utf-8', errors='ignore').strip()
+                # Keep raw bytes here, decoding is deferred to the consumer
+                line = ser.readline().strip()
                 if line:
-                    self.serial_output.put(line)
+                    # Echo boot log while someone is waiting for readiness
+                    if self._echo_serial:
+                        print(f"📟 {line.decode('utf-8', errors='ignore')}")
+                    else:
+                        self.serial_output.put(line)
                     
                     # Check for ready indicators
-                    if "MQTT connesso al broker" in line or "WiFi connesso" in line:
+                    if READY_PATTERN.search(line):
                         self.esp32_ready = True
+                        self._ready_event.set()
                         
         except Exception as e:
             print(f"⚠️ Serial monitoring error: {e}")
@@ -129,25 +164,16 @@ class ESP32TestRunner:
                 return True
         
         # Start serial monitoring
+        self._echo_serial = True
         self.serial_thread = threading.Thread(target=self._monitor_serial, daemon=True)
         self.serial_thread.start()
         
-        start_time = time.time()
+        ready = self._ready_event.wait(timeout)
+        self._echo_serial = False
         
-        while (time.time() - start_time) < timeout:
-            # Show recent serial output
-            while not self.serial_output.empty():
-                try:
-                    line = self.serial_output.get_nowait()
-                    print(f"📟 {line}")
-                except queue.Empty:
-                    break
-            
-            if self.esp32_ready:
-                print("✅ ESP32 is ready for testing!")
-                return True
-            
-            time.sleep(1)
+        if ready:
+            print("✅ ESP32 is ready for testing!")
+            return True
         
         print("⚠️ Timeout waiting for ESP32 ready, proceeding anyway...")
         return False
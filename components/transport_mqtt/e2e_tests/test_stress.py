@@ -1,8 +1,10 @@
 import pytest
 import time
-import threading
 import random
-from conftest import send_command, wait_for_response
+import asyncio
+import orjson
+import aiomqtt
+from conftest import send_command, send_commands, wait_for_response
 
 def test_high_frequency_commands(mqtt_client, esp32_topics):
     """Test high frequency command sending"""
@@ -13,17 +15,12 @@ def test_high_frequency_commands(mqtt_client, esp32_topics):
     
     # Send commands as fast as possible
     start_time = time.time()
-    
-    for i in range(num_commands):
-        cmd_id = 100 + i
-        send_command(mqtt_client, cmd_id, "ping")
-    
+    send_commands(mqtt_client, [(100 + i, "ping", None) for i in range(num_commands)])
     send_duration = time.time() - start_time
+    
     print(f"📤 Sent {num_commands} commands in {send_duration:.2f}s")
     
     # Collect responses
-    start_time = time.time()
-    
     for i in range(num_commands):
         expected_id = 100 + i
         response = wait_for_response(mqtt_client, expected_id, timeout=15)
@@ -42,7 +39,8 @@ def test_high_frequency_commands(mqtt_client, esp32_topics):
     
     print(f"✅ High frequency test: {success_rate:.2%} success rate")
 
-def test_concurrent_clients(mqtt_client, esp32_topics):
+@pytest.mark.asyncio
+async def test_concurrent_clients(mqtt_broker, mqtt_client, esp32_topics):
     """Test multiple concurrent MQTT clients"""
     print("🧪 Testing concurrent MQTT clients...")
     
@@ -50,33 +48,48 @@ def test_concurrent_clients(mqtt_client, esp32_topics):
     responses = []
     errors = []
     
-    def client_worker(client_id, start_cmd_id):
-        try:
-            for i in range(5):
-                cmd_id = start_cmd_id + i
-                send_command(mqtt_client, cmd_id, "ping")
-                
-                response = wait_for_response(mqtt_client, cmd_id, timeout=10)
-                if response:
-                    responses.append(response)
-                else:
-                    errors.append(f"No response for client {client_id} cmd {cmd_id}")
+    async def client_worker(client_id, start_cmd_id):
+        # Every client sees every response, so each routes its own by correlation id
+        pending = {}
+        
+        async def route_responses(messages):
+            async for message in messages:
+                try:
+                    data = orjson.loads(message.payload)
+                except orjson.JSONDecodeError:
+                    continue
                 
-                time.sleep(0.1)  # Small delay between commands
+                if isinstance(data, dict):
+                    future = pending.pop(data.get("id"), None)
+                    if future and not future.done():
+                        future.set_result(data)
+        
+        try:
+            async with aiomqtt.Client(mqtt_broker["host"], mqtt_broker["port"]) as client:
+                async with client.messages() as messages:
+                    await client.subscribe(esp32_topics["resp"])
+                    router = asyncio.create_task(route_responses(messages))
+                    
+                    try:
+                        for i in range(5):
+                            cmd_id = start_cmd_id + i
+                            future = asyncio.get_running_loop().create_future()
+                            pending[cmd_id] = future
+                            
+                            await client.publish(esp32_topics["cmd"], orjson.dumps({"id": cmd_id, "op": "ping"}))
+                            
+                            try:
+                                responses.append(await asyncio.wait_for(future, timeout=10))
+                            except asyncio.TimeoutError:
+                                pending.pop(cmd_id, None)
+                                errors.append(f"No response for client {client_id} cmd {cmd_id}")
+                    finally:
+                        router.cancel()
         except Exception as e:
             errors.append(f"Client {client_id} error: {e}")
     
-    # Start multiple "clients" (threads using same MQTT connection)
-    threads = []
-    for client_id in range(3):
-        start_cmd_id = 200 + (client_id * 10)
-        thread = threading.Thread(target=client_worker, args=(client_id, start_cmd_id))
-        threads.append(thread)
-        thread.start()
-    
-    # Wait for all threads to complete
-    for thread in threads:
-        thread.join()
+    # Run multiple independent clients concurrently on one event loop
+    await asyncio.gather(*(client_worker(client_id, 200 + (client_id * 10)) for client_id in range(3)))
     
     print(f"📊 Concurrent test results:")
     print(f"  - Responses received: {len(responses)}")
@@ -175,8 +188,7 @@ def test_connection_resilience(mqtt_client, esp32_topics):
             print("🔌 Simulating brief disconnection...")
             mqtt_client.disconnect()
             time.sleep(1)
-            mqtt_client.connect()
-            mqtt_client.subscribe("smartdrip/resp")
+            mqtt_client.connect()  # Subscription restored on connect
             print("🔗 Reconnected")
         
         # Wait for response
@@ -216,9 +228,6 @@ def test_random_command_sequence(mqtt_client, esp32_topics):
             print(f"  ✅ Response: status={response['status']}")
         else:
             print(f"  ❌ No response")
-        
-        # Random delay between commands
-        time.sleep(random.uniform(0.1, 0.5))
     
     success_rate = len(responses) / 15
     assert success_rate >= 0.8, f"Random sequence success rate too low: {success_rate:.2f}"
@@ -29,56 +29,90 @@ Esempi:
 
     # Connessione a MAC specifico
     python send_cmd.py --mac AA:BB:CC:DD:EE:FF --op wifiScan
+
+    # Connessione persistente: le invocazioni successive passano dal daemon
+    python send_cmd.py --daemon &
+    python send_cmd.py --op wifiScan
+
+    # Dump di ogni notifica ricevuta
+    python send_cmd.py --op wifiScan --verbose
 """
-import argparse, asyncio, json, sys, pathlib, time, random, struct
+import argparse, asyncio, json, logging, os, sys, pathlib, time, struct
 from bleak import BleakClient, BleakScanner
 
+try:
+    import orjson  # serializzazione JSON più veloce, opzionale
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop  # event loop libuv, opzionale (non disponibile su Windows)
+except ImportError:
+    uvloop = None
+
+log = logging.getLogger("ble")
+
 DEVICE_NAME      = "SMART_DRIP"
 CHAR_RX_UUID     = "0000ff01-0000-1000-8000-00805f9b34fb"
 CHAR_TX_UUID     = "0000ff02-0000-1000-8000-00805f9b34fb"
 
+# Encoder JSON compatto, creato una sola volta
+if orjson is not None:
+    _json_bytes = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    _json_loads = json.loads  # accetta bytes anche lui
+    _JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+    def _json_bytes(obj) -> bytes:
+        return _JSON_ENCODER.encode(obj).encode()
+
+# Tabella byte -> carattere alfanumerico per i payload di test
+_PAYLOAD_ALPHABET = b"abcdefghijklmnopqrstuvwxyz0123456789"
+_PAYLOAD_TABLE    = bytes(_PAYLOAD_ALPHABET[b % len(_PAYLOAD_ALPHABET)] for b in range(256))
+
+# Socket del daemon che tiene aperta la connessione BLE (--daemon)
+DAEMON_SOCKET = "/tmp/smartdrip_ble.sock"
+
 # Chunk flags (must match ESP32)
 CHUNK_FLAG_CHUNKED = 0x01
 CHUNK_FLAG_FINAL   = 0x02
 CHUNK_FLAG_MORE    = 0x04
 
-def build_frame(req_id: int, op: str, payload: dict) -> bytes:
+# struct chunk_header_t { uint8_t flags; uint8_t chunk_idx; uint8_t total_chunks; uint16_t frame_id; uint16_t chunk_size; }
+_CHUNK_HDR = struct.Struct('<BBBHH')
+# Offset di frame_id nell'header: dopo flags, chunk_idx e total_chunks
+_CHUNK_FRAME_ID_OFFSET = struct.calcsize('<BBB')
+
+def _build_frame_tail(op: str, payload: dict) -> bytes:
+    """Parte del frame che non dipende dal req_id: op_len + op + JSON"""
     op_b = op.encode()
     if len(op_b) > 15:
         raise ValueError("op string too long (max 15 bytes)")
-    data_b = json.dumps(payload, separators=(",", ":")).encode()
-    frame  = bytearray()
-    frame += req_id.to_bytes(2, "little")
-    frame.append(len(op_b))
-    frame += op_b
-    frame += data_b
-    return bytes(frame)
+    data_b = _json_bytes(payload)
+    tail   = bytearray(1 + len(op_b) + len(data_b))
+    tail[0] = len(op_b)
+    tail[1:1 + len(op_b)] = op_b
+    tail[1 + len(op_b):]  = data_b
+    return bytes(tail)
+
+def build_frame(req_id: int, op: str, payload: dict) -> bytes:
+    return struct.pack("<H", req_id) + _build_frame_tail(op, payload)
 
 def build_large_payload(target_size: int) -> dict:
     """Genera un payload JSON di dimensione specifica per test chunking"""
-    base_data = []
-    current_size = 50  # overhead stimato
-    
-    while current_size < target_size:
-        remaining = target_size - current_size
-        chunk_size = min(remaining - 10, 40)
-        if chunk_size > 0:
-            random_str = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=chunk_size))
-            base_data.append(random_str)
-            current_size += len(json.dumps(random_str)) + 2
-        else:
-            break
-    
-    return {"testData": base_data, "payloadSize": target_size}
+    # Una sola stringa random: os.urandom + translate sull'alfabeto, tutto in C
+    string_size = max(target_size - 50, 0)  # 50 = overhead stimato
+    random_str = os.urandom(string_size).translate(_PAYLOAD_TABLE).decode("ascii")
+    return {"testData": [random_str], "payloadSize": target_size}
 
 def create_chunk_header(flags: int, chunk_idx: int, total_chunks: int, frame_id: int, chunk_size: int) -> bytes:
     """Creates a chunk header matching ESP32 format"""
-    # struct chunk_header_t { uint8_t flags; uint8_t chunk_idx; uint8_t total_chunks; uint16_t frame_id; uint16_t chunk_size; }
-    return struct.pack('<BBBHH', flags, chunk_idx, total_chunks, frame_id, chunk_size)
+    return _CHUNK_HDR.pack(flags, chunk_idx, total_chunks, frame_id, chunk_size)
 
 def chunk_frame(frame_data: bytes, max_chunk_size: int, frame_id: int) -> list[bytes]:
     """Split a frame into chunks for BLE transmission"""
-    chunk_header_size = 7  # sizeof(chunk_header_t)
+    chunk_header_size = _CHUNK_HDR.size  # sizeof(chunk_header_t)
     effective_chunk_size = max_chunk_size - chunk_header_size
     
     if len(frame_data) <= max_chunk_size:
@@ -91,10 +125,10 @@ def chunk_frame(frame_data: bytes, max_chunk_size: int, frame_id: int) -> list[b
     if total_chunks > 8:
         raise ValueError(f"Frame too large: needs {total_chunks} chunks (max 8)")
     
-    offset = 0
-    for i in range(total_chunks):
-        remaining = len(frame_data) - offset
-        chunk_payload_size = min(remaining, effective_chunk_size)
+    frame_view = memoryview(frame_data)
+    for i, offset in enumerate(range(0, len(frame_data), effective_chunk_size)):
+        payload_view = frame_view[offset:offset + effective_chunk_size]
+        chunk_payload_size = len(payload_view)
         
         # Determine flags
         flags = CHUNK_FLAG_CHUNKED
@@ -103,47 +137,156 @@ def chunk_frame(frame_data: bytes, max_chunk_size: int, frame_id: int) -> list[b
         else:
             flags |= CHUNK_FLAG_MORE
         
-        # Create chunk
-        header = create_chunk_header(flags, i, total_chunks, frame_id, chunk_payload_size)
-        payload = frame_data[offset:offset + chunk_payload_size]
-        chunk = header + payload
+        # Create chunk: header written in place, payload copied once from the view
+        chunk = bytearray(chunk_header_size + chunk_payload_size)
+        _CHUNK_HDR.pack_into(chunk, 0, flags, i, total_chunks, frame_id, chunk_payload_size)
+        chunk[chunk_header_size:] = payload_view
         
-        chunks.append(chunk)
-        offset += chunk_payload_size
+        chunks.append(chunk)  # bleak accetta anche bytearray, niente copia in bytes
     
     return chunks
 
+async def _await_with_timeout(fut: asyncio.Future, timeout: float):
+    """Attende fut, che fallisce con TimeoutError dopo timeout secondi (senza task wrapper)"""
+    loop = asyncio.get_running_loop()
+    handle = loop.call_later(timeout, lambda: fut.done() or fut.set_exception(asyncio.TimeoutError()))
+    try:
+        return await fut
+    finally:
+        handle.cancel()
+
 async def discover_device(mac: str | None):
     if mac:
         return await BleakScanner.find_device_by_address(mac, timeout=6.0)
     print("Scanning for", DEVICE_NAME, "…")
-    for d in await BleakScanner.discover(6.0):
-        if d.name == DEVICE_NAME:
-            return d
-    return None
+    # Si ferma al primo advertising che corrisponde, senza attendere tutta la scansione
+    return await BleakScanner.find_device_by_filter(
+        lambda d, adv: d.name == DEVICE_NAME, timeout=6.0
+    )
 
 def get_test_counter():
     """Get a persistent test counter to track pattern"""
     counter_file = "/tmp/ble_test_counter.txt"
+    # Un solo descrittore, contatore come uint64 LE a offset 0
+    fd = os.open(counter_file, os.O_RDWR | os.O_CREAT, 0o644)
     try:
-        with open(counter_file, "r") as f:
-            counter = int(f.read().strip())
-    except (FileNotFoundError, ValueError):
-        counter = 0
-    
-    counter += 1
-    with open(counter_file, "w") as f:
-        f.write(str(counter))
+        raw = os.pread(fd, 20, 0)  # 20 = cifre di un uint64 nel vecchio formato testo
+        if raw.isdigit():
+            # Vecchio formato: contatore decimale in testo, riconosciuto dal contenuto
+            counter = int(raw) + 1
+        elif len(raw) >= 8:
+            counter = struct.unpack_from('<Q', raw)[0] + 1
+        else:
+            counter = 1
+        os.pwrite(fd, struct.pack('<Q', counter), 0)
+        os.ftruncate(fd, 8)  # via eventuali cifre residue del formato testo
+    finally:
+        os.close(fd)
     
     return counter
 
+async def send_frame(client: BleakClient, frame: bytes, max_chunk_size: int, frame_id: int,
+                     force_chunking: bool) -> int:
+    """Invia un frame, a chunk se supera l'MTU (o se forzato). Ritorna il numero di write"""
+    if not (force_chunking or len(frame) > max_chunk_size):
+        print(f"📤 Sending direct frame: {len(frame)} bytes")
+        await client.write_gatt_char(CHAR_RX_UUID, frame, response=False)
+        return 1
+    
+    chunks = chunk_frame(frame, max_chunk_size, frame_id)
+    print(f"📦 Chunking frame into {len(chunks)} parts (MTU: {max_chunk_size + 3})")
+    await send_chunks(client, chunks)
+    return len(chunks)
+
+async def send_chunks(client: BleakClient, chunks: list[bytes]):
+    """Send all chunks back-to-back (write-without-response)"""
+    async def send_chunk(j, chunk):
+        print(f"📤 Sending chunk {j+1}/{len(chunks)}: {len(chunk)} bytes")
+        await client.write_gatt_char(CHAR_RX_UUID, chunk, response=False)
+    
+    # Nessun limite di write in volo: al massimo 8 chunk per frame. L'ordine dei
+    # chunk si basa solo sul fatto che gather avvia i task (e le write) in ordine
+    await asyncio.gather(*(send_chunk(j, chunk) for j, chunk in enumerate(chunks)))
+
+async def serve_daemon(client: BleakClient, disconnected: asyncio.Event):
+    """Tiene aperta la connessione BLE e accetta comandi JSON (uno per riga) su DAEMON_SOCKET.
+
+    Richiesta:  {"frames": [hex, ...], "force_chunking": bool, "expect": N, "timeout": s}
+    Risposta:   {"notifications": [hex, ...]}
+    """
+    loop = asyncio.get_running_loop()
+    max_chunk_size = client.mtu_size - 3  # ATT header overhead
+    link_lock = asyncio.Lock()  # una richiesta alla volta sul link BLE
+    pending = None  # (notifiche, attese, future) della richiesta in corso
+    
+    def on_notify(_, data):
+        if pending is None:
+            return
+        notifications, expect, fut = pending
+        notifications.append(bytes(data))
+        if len(notifications) >= expect and not fut.done():
+            fut.set_result(notifications)
+    
+    async def handle(reader, writer):
+        nonlocal pending
+        try:
+            while line := await reader.readline():
+                req = _json_loads(line)
+                notifications = []
+                async with link_lock:
+                    expect = req.get("expect", 1)
+                    pending = (notifications, expect, loop.create_future())
+                    try:
+                        for i, frame_hex in enumerate(req["frames"]):
+                            await send_frame(client, bytes.fromhex(frame_hex), max_chunk_size, 1000 + i,
+                                             req.get("force_chunking", False))
+                        if expect:
+                            await _await_with_timeout(pending[2], req.get("timeout", 30))
+                    except asyncio.TimeoutError:
+                        print(f"❌ Timeout: {len(notifications)}/{expect} notifiche ricevute")
+                    finally:
+                        pending = None
+                writer.write(_json_bytes({"notifications": [n.hex() for n in notifications]}) + b"\n")
+                await writer.drain()
+        finally:
+            writer.close()
+    
+    await client.start_notify(CHAR_TX_UUID, on_notify)
+    if os.path.exists(DAEMON_SOCKET):
+        os.unlink(DAEMON_SOCKET)  # socket rimasto da un daemon precedente
+    server = await asyncio.start_unix_server(handle, path=DAEMON_SOCKET)
+    print(f"🛰️  Daemon in ascolto su {DAEMON_SOCKET} (MTU: {client.mtu_size})")
+    try:
+        async with server:
+            await disconnected.wait()
+        print("🔌 Connessione BLE persa, daemon terminato")
+    finally:
+        os.unlink(DAEMON_SOCKET)
+
+async def send_via_daemon(frames: list[bytes], force_chunking: bool, expect: int, timeout: float):
+    """Invia i frame tramite il daemon; None se il daemon non risponde"""
+    try:
+        reader, writer = await asyncio.open_unix_connection(DAEMON_SOCKET)
+    except OSError:
+        return None
+    try:
+        request = {"frames": [f.hex() for f in frames], "force_chunking": force_chunking,
+                   "expect": expect, "timeout": timeout}
+        writer.write(_json_bytes(request) + b"\n")
+        await writer.drain()
+        response = _json_loads(await reader.readline())
+        return [bytes.fromhex(n) for n in response["notifications"]]
+    finally:
+        writer.close()
+
 async def main():
+    loop = asyncio.get_running_loop()  # loop.time(): orologio monotono per le misure
     test_num = get_test_counter()
     print(f"🧪 TEST #{test_num} - Pattern tracking")
     
     ap = argparse.ArgumentParser()
     ap.add_argument("--mac",       help="MAC address del dispositivo")
-    ap.add_argument("--op",        required=True, choices=["syncSchedule","wifiScan","wifiConfigure"])
+    ap.add_argument("--op",        choices=["syncSchedule","wifiScan","wifiConfigure"])
     ap.add_argument("--id",        type=int, default=1, help="request-id (default 1)")
     ap.add_argument("--ssid",      help="SSID per wifiConfigure")
     ap.add_argument("--pass",      dest="password", help="Password per wifiConfigure")
@@ -156,7 +299,26 @@ async def main():
                    help="Ripete il comando N volte per test back-pressure")
     ap.add_argument("--force-chunking", action="store_true", 
                    help="Forza chunking anche per frame piccoli (test)")
+    ap.add_argument("--verbose", "-v", action="store_true",
+                   help="Log di ogni notifica ricevuta (hex + chunk header)")
+    ap.add_argument("--daemon", action="store_true",
+                   help=f"Resta connesso e accetta comandi su {DAEMON_SOCKET}")
+    ap.add_argument("--no-daemon", action="store_true",
+                   help="Connettiti direttamente anche se il daemon è attivo")
     args = ap.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO, format="%(message)s")
+
+    if args.daemon:
+        dev = await discover_device(args.mac)
+        if dev is None:
+            print("Dispositivo non trovato"); sys.exit(1)
+        disconnected = asyncio.Event()
+        async with BleakClient(dev, disconnected_callback=lambda _: disconnected.set()) as client:
+            print(f"🔗 Connesso a {dev.address}")
+            await serve_daemon(client, disconnected)
+        return
+    if not args.op:
+        ap.error("--op obbligatorio (tranne con --daemon)")
 
     # ---- payload ----------------------------------------------------------------------------------------------------
     if args.large_payload:
@@ -177,13 +339,28 @@ async def main():
         if not args.json:
             ap.error("--json obbligatorio con syncSchedule")
         path = pathlib.Path(args.json)
-        payload = json.loads(path.read_text(encoding="utf-8"))
+        payload = _json_loads(path.read_bytes())
 
-    frame = build_frame(args.id, args.op, payload)
+    # JSON serializzato una volta sola: con --repeat cambia solo il req_id
+    frame_tail = _build_frame_tail(args.op, payload)
+    frame = struct.pack("<H", args.id) + frame_tail
     
     if args.large_payload:
         print(f"📏 Frame generato per test chunking: {len(frame)} bytes (target: {args.large_payload})")
 
+    # ---- daemon (connessione già aperta) ----------------------------------------------------------------------------
+    if not args.no_daemon and os.path.exists(DAEMON_SOCKET):
+        frames = [struct.pack("<H", args.id + i) + frame_tail for i in range(args.repeat)]
+        expect = 0 if args.no_notify else args.repeat
+        start_time = loop.time()
+        notifications = await send_via_daemon(frames, args.force_chunking, expect, 30)
+        if notifications is not None:
+            total_time = (loop.time() - start_time) * 1000
+            print(f"🛰️  Inviato tramite daemon: {len(notifications)}/{expect} notifiche in {total_time:.1f}ms")
+            print(f"📊 Total data received: {sum(len(n) for n in notifications)} bytes")
+            return
+        print("⚠️  Daemon non raggiungibile, connessione diretta")
+
     # ---- connessione ------------------------------------------------------------------------------------------------
     dev = await discover_device(args.mac)
     if dev is None:
@@ -194,68 +371,73 @@ async def main():
         print(f"🔗 Connesso a {dev.address} – MTU: {client.mtu_size}, invio op: {args.op}")
         print(f"🔗 Connection established at {connect_time:.1f}")
         
-        notifications_received = []
+        # Solo contatori: i dati delle notifiche non vengono trattenuti
+        received = {"count": 0, "bytes": 0}
         
         if not args.no_notify:
             # 1. abilita notify PRIMA di scrivere
-            fut = asyncio.get_event_loop().create_future()
+            fut = loop.create_future()
 
             async def on_notify(_, data):
-                notifications_received.append(data)
-                timestamp = time.time() - total_start_time
-                print(f"📨 Notify {len(notifications_received)}: {len(data)} bytes at +{timestamp:.1f}s - {data[:20].hex()}...")
+                received["count"] += 1
+                received["bytes"] += len(data)
                 
-                # Decode potential chunk header for debugging
-                if len(data) >= 7:  # sizeof(chunk_header_t)
-                    flags, chunk_idx, total_chunks, frame_id, chunk_size = struct.unpack('<BBBHH', data[:7])
-                    if flags & CHUNK_FLAG_CHUNKED:
-                        print(f"   📦 Chunk header: idx={chunk_idx}, total={total_chunks}, frame_id={frame_id}, size={chunk_size}")
+                # Hex dump e decodifica header solo con --verbose
+                if log.isEnabledFor(logging.DEBUG):
+                    timestamp = loop.time() - total_start_time
+                    log.debug("📨 Notify %d: %d bytes at +%.1fs - %s...",
+                              received["count"], len(data), timestamp, memoryview(data)[:20].hex())
+                    
+                    # Decode potential chunk header for debugging
+                    if len(data) >= _CHUNK_HDR.size:
+                        flags, chunk_idx, total_chunks, frame_id, chunk_size = _CHUNK_HDR.unpack_from(data, 0)
+                        if flags & CHUNK_FLAG_CHUNKED:
+                            log.debug("   📦 Chunk header: idx=%d, total=%d, frame_id=%d, size=%d",
+                                      chunk_idx, total_chunks, frame_id, chunk_size)
                 
                 # Per test con repeat, aspetta multiple notifiche
-                if len(notifications_received) >= args.repeat:
+                if received["count"] >= args.repeat:
                     if not fut.done():
-                        fut.set_result(notifications_received)
+                        fut.set_result(received["count"])
 
             await client.start_notify(CHAR_TX_UUID, on_notify)   # ① subscribe PRIMA
 
         # 2. invia il comando (ripetuto se richiesto)
-        total_start_time = time.time()
+        total_start_time = loop.time()
         mtu = client.mtu_size
         max_chunk_size = mtu - 3  # ATT header overhead
         
+        # Le ripetizioni hanno tutte la stessa lunghezza: chunk una volta sola
+        if args.force_chunking or len(frame) > max_chunk_size:
+            chunks = chunk_frame(frame, max_chunk_size, 1000)
+        else:
+            chunks = [frame]
+        if len(chunks) > 1:
+            print(f"📦 Chunking frame into {len(chunks)} parts (MTU: {mtu})")
+        
         for i in range(args.repeat):
             if args.repeat > 1:
-                # Per test back-pressure, modifica request ID
-                current_frame = build_frame(args.id + i, args.op, payload)
                 print(f"📤 Invio comando {i+1}/{args.repeat}")
             else:
-                current_frame = frame
-                print(f"📤 Frame to send: {len(current_frame)} bytes")
-            
-            # Decide se chuncare
-            should_chunk = args.force_chunking or len(current_frame) > max_chunk_size
+                print(f"📤 Frame to send: {len(frame)} bytes")
             
-            if should_chunk:
-                # Chunk the frame
-                frame_id = 1000 + i  # Unique frame ID
-                chunks = chunk_frame(current_frame, max_chunk_size, frame_id)
-                print(f"📦 Chunking frame into {len(chunks)} parts (MTU: {mtu})")
-                
-                # Send all chunks
+            if len(chunks) > 1:
+                # Stessi chunk a ogni ripetizione: si aggiornano solo frame_id
+                # (univoco per ripetizione) e request ID (inizio del frame, chunk 0)
                 for j, chunk in enumerate(chunks):
-                    print(f"📤 Sending chunk {j+1}/{len(chunks)}: {len(chunk)} bytes")
-                    await client.write_gatt_char(CHAR_RX_UUID, chunk, response=False)
-                    
-                    # Small delay between chunks
-                    if j < len(chunks) - 1:
-                        await asyncio.sleep(0.05)
-                        
+                    struct.pack_into("<H", chunk, _CHUNK_FRAME_ID_OFFSET, 1000 + i)
+                    # Round-trip: la patch non deve toccare gli altri campi dell'header
+                    flags, chunk_idx, _, frame_id, _ = _CHUNK_HDR.unpack_from(chunk, 0)
+                    assert flags & CHUNK_FLAG_CHUNKED and chunk_idx == j and frame_id == 1000 + i, \
+                        f"chunk header corrotto dalla patch di frame_id: {bytes(chunk[:_CHUNK_HDR.size]).hex()}"
+                struct.pack_into("<H", chunks[0], _CHUNK_HDR.size, args.id + i)
+                await send_chunks(client, chunks)
             else:
-                # Send directly
-                send_timestamp = time.time()
-                print(f"📤 Sending direct frame: {len(current_frame)} bytes at +{send_timestamp - total_start_time:.1f}s")
+                # Per test back-pressure, modifica request ID
+                current_frame = struct.pack("<H", args.id + i) + frame_tail
+                print(f"📤 Sending direct frame: {len(current_frame)} bytes")
                 await client.write_gatt_char(CHAR_RX_UUID, current_frame, response=False)
-                print(f"📤 Frame sent successfully at +{time.time() - total_start_time:.1f}s")
+                print(f"📤 Frame sent successfully at +{loop.time() - total_start_time:.1f}s")
             
             if args.repeat > 1 and i < args.repeat - 1:
                 await asyncio.sleep(0.2)  # Delay tra comandi per test back-pressure
@@ -265,26 +447,26 @@ async def main():
             timeout = 30  # Timeout più lungo per WiFi scan e operazioni lunghe
             try:
                 print(f"⏳ Waiting for {args.repeat} notification(s) with {timeout}s timeout...")
-                await asyncio.wait_for(fut, timeout)
-                total_time = (time.time() - total_start_time) * 1000
-                print(f"✅ Ricevute {len(notifications_received)} notifiche in {total_time:.1f}ms")
+                await _await_with_timeout(fut, timeout)
+                total_time = (loop.time() - total_start_time) * 1000
+                print(f"✅ Ricevute {received['count']} notifiche in {total_time:.1f}ms")
                 
                 if args.repeat > 1:
-                    avg_time = total_time / len(notifications_received) if notifications_received else 0
+                    avg_time = total_time / received["count"] if received["count"] else 0
                     print(f"📊 Tempo medio per comando: {avg_time:.1f}ms")
                 
                 # Summary of received data
-                total_bytes = sum(len(notif) for notif in notifications_received)
-                print(f"📊 Total data received: {total_bytes} bytes")
+                print(f"📊 Total data received: {received['bytes']} bytes")
                     
             except asyncio.TimeoutError:
-                timeout_time = time.time() - total_start_time
-                print(f"❌ Timeout after {timeout_time:.1f}s: {len(notifications_received)}/{args.repeat} notifiche ricevute")
-                if notifications_received:
-                    total_bytes = sum(len(notif) for notif in notifications_received)
-                    print(f"📊 Partial data received: {total_bytes} bytes")
+                timeout_time = loop.time() - total_start_time
+                print(f"❌ Timeout after {timeout_time:.1f}s: {received['count']}/{args.repeat} notifiche ricevute")
+                if received["count"]:
+                    print(f"📊 Partial data received: {received['bytes']} bytes")
 
             await client.stop_notify(CHAR_TX_UUID)
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
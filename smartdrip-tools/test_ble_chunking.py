@@ -18,80 +18,98 @@ Esempi di test:
     # Test MTU negotiation
     python test_ble_chunking.py --test mtu
 """
-import argparse, asyncio, json, sys, time, random
+import argparse, asyncio, json, os, sys, time, struct
 from bleak import BleakClient, BleakScanner
 
+try:
+    import orjson  # serializzazione JSON più veloce, opzionale
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop  # event loop libuv, opzionale (non disponibile su Windows)
+except ImportError:
+    uvloop = None
+
 DEVICE_NAME      = "SMART_DRIP"
 CHAR_RX_UUID     = "0000ff01-0000-1000-8000-00805f9b34fb"
 CHAR_TX_UUID     = "0000ff02-0000-1000-8000-00805f9b34fb"
 
+# Encoder JSON compatto, creato una sola volta
+if orjson is not None:
+    _json_bytes = orjson.dumps
+else:
+    _JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False)
+
+    def _json_bytes(obj) -> bytes:
+        return _JSON_ENCODER.encode(obj).encode()
+
+# Tabella byte -> carattere alfanumerico per i payload di test
+_PAYLOAD_ALPHABET = b"abcdefghijklmnopqrstuvwxyz0123456789"
+_PAYLOAD_TABLE    = bytes(_PAYLOAD_ALPHABET[b % len(_PAYLOAD_ALPHABET)] for b in range(256))
+
 def build_frame(req_id: int, op: str, payload: dict) -> bytes:
     """Costruisce un frame di comando"""
     op_b = op.encode()
     if len(op_b) > 15:
         raise ValueError("op string too long (max 15 bytes)")
-    data_b = json.dumps(payload, separators=(",", ":")).encode()
-    frame  = bytearray()
-    frame += req_id.to_bytes(2, "little")
-    frame.append(len(op_b))
-    frame += op_b
-    frame += data_b
+    data_b = _json_bytes(payload)
+    frame  = bytearray(3 + len(op_b) + len(data_b))
+    struct.pack_into("<HB", frame, 0, req_id, len(op_b))
+    frame[3:3 + len(op_b)] = op_b
+    frame[3 + len(op_b):]  = data_b
     return bytes(frame)
 
 def build_large_payload(size: int) -> dict:
     """Genera un payload JSON di dimensione specifica per test chunking"""
-    # Crea una lista di stringhe per raggiungere la dimensione desiderata
-    base_data = []
-    current_size = 20  # overhead del frame base
-    
-    while current_size < size:
-        # Aggiunge stringhe random per riempire
-        remaining = size - current_size
-        chunk_size = min(remaining - 10, 50)  # -10 per overhead JSON
-        if chunk_size > 0:
-            random_str = ''.join(random.choices('abcdefghijklmnopqrstuvwxyz0123456789', k=chunk_size))
-            base_data.append(random_str)
-            current_size += len(json.dumps(random_str)) + 1  # +1 per comma
-        else:
-            break
-    
-    return {"testData": base_data, "size": size}
+    # Una sola stringa random: os.urandom + translate sull'alfabeto, tutto in C
+    string_size = max(size - 20, 0)  # 20 = overhead del frame base
+    random_str = os.urandom(string_size).translate(_PAYLOAD_TABLE).decode("ascii")
+    return {"testData": [random_str], "size": size}
 
 async def discover_device(mac: str | None):
     if mac:
         return await BleakScanner.find_device_by_address(mac, timeout=8.0)
     print("🔍 Scanning for", DEVICE_NAME, "...")
-    for d in await BleakScanner.discover(8.0):
-        if d.name == DEVICE_NAME:
-            return d
-    return None
+    # Si ferma al primo advertising che corrisponde, senza attendere tutta la scansione
+    return await BleakScanner.find_device_by_filter(
+        lambda d, adv: d.name == DEVICE_NAME, timeout=8.0
+    )
 
 class TestNotifyHandler:
     """Handler per gestire le notifiche BLE durante i test"""
     def __init__(self):
-        self.notifications = []
+        # Solo contatori: i dati delle notifiche non vengono trattenuti
+        self.count = 0
+        self.total_bytes = 0
         self.expected_count = 0
-        self.future = None
+        self._done = asyncio.Event()  # riusato a ogni ciclo di test
         
     def reset(self, expected_count=1):
-        self.notifications.clear()
+        self.count = 0
+        self.total_bytes = 0
         self.expected_count = expected_count
-        self.future = asyncio.get_event_loop().create_future()
+        self._done.clear()
         
     async def on_notify(self, _, data):
-        self.notifications.append(data)
-        print(f"📨 Notify {len(self.notifications)}/{self.expected_count}: {len(data)} bytes - {data[:20].hex()}...")
+        self.count += 1
+        self.total_bytes += len(data)
+        print(f"📨 Notify {self.count}/{self.expected_count}: {len(data)} bytes - {memoryview(data)[:20].hex()}...")
         
-        if len(self.notifications) >= self.expected_count:
-            if not self.future.done():
-                self.future.set_result(self.notifications)
+        if self.count >= self.expected_count:
+            self._done.set()
     
     async def wait_for_notifications(self, timeout=15):
+        # Il timeout sblocca lo stesso Event, senza task wrapper
+        handle = asyncio.get_running_loop().call_later(timeout, self._done.set)
         try:
-            return await asyncio.wait_for(self.future, timeout)
-        except asyncio.TimeoutError:
-            print(f"❌ Timeout: received {len(self.notifications)}/{self.expected_count} notifications")
-            return self.notifications
+            await self._done.wait()
+        finally:
+            handle.cancel()
+        
+        if self.count < self.expected_count:
+            print(f"❌ Timeout: received {self.count}/{self.expected_count} notifications")
+        return self.count
 
 async def test_chunking(client: BleakClient, notify_handler: TestNotifyHandler, frame_size: int):
     """Test chunking automatico con frame grandi"""
@@ -119,13 +137,13 @@ async def test_chunking(client: BleakClient, notify_handler: TestNotifyHandler,
     await client.write_gatt_char(CHAR_RX_UUID, frame, response=False)
     
     # Aspetta risposta(e)
-    notifications = await notify_handler.wait_for_notifications(20)
+    received = await notify_handler.wait_for_notifications(20)
     end_time = time.time()
     
     print(f"⏱️  Tempo totale: {(end_time - start_time)*1000:.1f}ms")
-    print(f"✅ Ricevute {len(notifications)} notifiche")
+    print(f"✅ Ricevute {received} notifiche ({notify_handler.total_bytes} bytes)")
     
-    return len(notifications) > 0
+    return received > 0
 
 async def test_backpressure(client: BleakClient, notify_handler: TestNotifyHandler, command_count: int):
     """Test back-pressure con raffica di comandi"""
@@ -146,13 +164,13 @@ async def test_backpressure(client: BleakClient, notify_handler: TestNotifyHandl
         await asyncio.sleep(0.1)
     
     # Aspetta tutte le risposte
-    notifications = await notify_handler.wait_for_notifications(30)
+    received = await notify_handler.wait_for_notifications(30)
     end_time = time.time()
     
     print(f"⏱️  Tempo totale: {(end_time - start_time)*1000:.1f}ms")
-    print(f"✅ Ricevute {len(notifications)}/{command_count} risposte")
+    print(f"✅ Ricevute {received}/{command_count} risposte")
     
-    return len(notifications) == command_count
+    return received == command_count
 
 async def test_mtu_negotiation(client: BleakClient, notify_handler: TestNotifyHandler):
     """Test MTU negotiation e adattamento chunking"""
@@ -174,14 +192,14 @@ async def test_mtu_negotiation(client: BleakClient, notify_handler: TestNotifyHa
         start_time = time.time()
         await client.write_gatt_char(CHAR_RX_UUID, frame, response=False)
         
-        notifications = await notify_handler.wait_for_notifications(10)
+        received = await notify_handler.wait_for_notifications(10)
         end_time = time.time()
         
-        success = len(notifications) > 0
+        success = received > 0
         latency = (end_time - start_time) * 1000
         
-        print(f"📊 Size: {actual_size}B, Success: {success}, Latency: {latency:.1f}ms, Chunks: {len(notifications)}")
-        results.append((actual_size, success, latency, len(notifications)))
+        print(f"📊 Size: {actual_size}B, Success: {success}, Latency: {latency:.1f}ms, Chunks: {received}")
+        results.append((actual_size, success, latency, received))
         
         await asyncio.sleep(1)  # Pausa tra test
     
@@ -204,9 +222,9 @@ async def test_resilience(client: BleakClient, notify_handler: TestNotifyHandler
         
         try:
             await client.write_gatt_char(CHAR_RX_UUID, frame, response=False)
-            notifications = await notify_handler.wait_for_notifications(8)
+            received = await notify_handler.wait_for_notifications(8)
             
-            if len(notifications) > 0:
+            if received > 0:
                 successful_cycles += 1
                 print(f"✅ Ciclo {cycle + 1} riuscito")
             else:
@@ -270,4 +288,6 @@ async def main():
             await client.stop_notify(CHAR_TX_UUID)
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())
\ No newline at end of file
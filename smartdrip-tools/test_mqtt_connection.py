@@ -1,95 +1,314 @@
 #!/usr/bin/env python3
 """
-Quick MQTT WebSocket Connection Test
+Quick MQTT Connection Test
 
-Test veloce per verificare la connessione al broker EMQX via WebSocket
+Test veloce per verificare la connessione al broker EMQX.
+Default: TCP diretto (porta 1883); con --ws passa da WebSocket (porta 8083)
 """
 
+import argparse
+import asyncio
 import paho.mqtt.client as mqtt
 import time
 import json
+import queue
+import socket
+import threading
+import zlib
 
-def test_emqx_connection():
+try:
+    import orjson  # serializzazione JSON più veloce, opzionale
+except ImportError:
+    orjson = None
+
+# Serializzatori risolti una volta sola: nessun lookup su json./orjson. per chiamata
+if orjson is not None:
+    _json_bytes = orjson.dumps
+    _json_loads = orjson.loads
+    _JSONDecodeError = orjson.JSONDecodeError
+
+    def _json_pretty(obj, _dumps=orjson.dumps, _option=orjson.OPT_INDENT_2) -> str:
+        return _dumps(obj, option=_option).decode()
+else:
+    _json_loads = json.loads  # accetta bytes anche lui
+    _JSONDecodeError = ValueError  # JSONDecodeError o UnicodeDecodeError su bytes
+    _JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+    _JSON_PRETTY_ENCODER = json.JSONEncoder(indent=2)
+
+    def _json_bytes(obj) -> bytes:
+        return _JSON_ENCODER.encode(obj).encode()
+
+    def _json_pretty(obj) -> str:
+        return _JSON_PRETTY_ENCODER.encode(obj)
+
+try:
+    import uvloop  # event loop libuv, opzionale (non disponibile su Windows)
+except ImportError:
+    uvloop = None
+
+# Payload di test serializzato una volta: a ogni run si riscrive solo il timestamp,
+# a larghezza fissa ("%17.6f", il padding a spazi resta JSON valido)
+_TS_WIDTH = 17
+_TEST_PAYLOAD = bytearray(_json_bytes({
+    "test": "mqtt_connection",
+    "timestamp": 0,
+    "message": "Hello from Python test client!"
+}).replace(b'"timestamp":0', b'"timestamp":' + b" " * _TS_WIDTH))
+_TS_OFFSET = _TEST_PAYLOAD.index(b'"timestamp":') + len(b'"timestamp":')
+
+def _test_payload() -> bytes:
+    """Payload di test con il timestamp corrente"""
+    _TEST_PAYLOAD[_TS_OFFSET:_TS_OFFSET + _TS_WIDTH] = b"%17.6f" % time.time()
+    return bytes(_TEST_PAYLOAD)
+
+# Payload oltre questa soglia vengono compressi con zlib (livello 1, CPU minima)
+COMPRESS_THRESHOLD = 512
+
+def _maybe_compress(data: bytes) -> bytes:
+    return zlib.compress(data, 1) if len(data) > COMPRESS_THRESHOLD else data
+
+def _maybe_decompress(data: bytes) -> bytes:
+    # Header zlib: CMF 0x78 (deflate, finestra 32K) e (CMF*256 + FLG) multiplo di 31
+    if len(data) > 2 and data[0] == 0x78 and int.from_bytes(data[:2], "big") % 31 == 0:
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            pass
+    return data
+
+BROKER_HOST    = "broker.emqx.io"
+BROKER_PORT    = 1883  # MQTT su TCP
+BROKER_WS_PORT = 8083  # MQTT su WebSocket
+
+TOPIC_PREFIX = "security1/esp32_test"
+SUB_TOPIC    = f"{TOPIC_PREFIX}/test/response"
+PUB_TOPIC    = f"{TOPIC_PREFIX}/test/request"
+
+class _AsyncioHelper:
+    """Fa girare il network loop di paho sull'event loop asyncio, senza il thread di loop_start()"""
+    
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        self.closed = asyncio.Event()
+        self._misc = None
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+    
+    def on_socket_open(self, client, userdata, sock):
+        # Disabilita Nagle: i pacchetti MQTT piccoli partono subito, senza attendere ACK
+        raw_sock = getattr(sock, "_socket", sock)  # il transport WebSocket incapsula il socket TCP
+        raw_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        
+        self.closed.clear()
+        self.loop.add_reader(sock, client.loop_read)
+        self._misc = self.loop.create_task(self._misc_loop())
+    
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.remove_reader(sock)
+        if self._misc is not None:
+            self._misc.cancel()
+        self.closed.set()
+    
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.add_writer(sock, client.loop_write)
+    
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.remove_writer(sock)
+    
+    async def _misc_loop(self):
+        # Keepalive e retry: quello che loop_start() faceva ogni secondo
+        while self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+            await asyncio.sleep(1)
+
+# Client riusati tra chiamate successive, per (host, port, transport)
+_clients = {}
+
+def _get_client(use_ws):
+    """Client MQTT condiviso per il transport richiesto; (client, già esistente)"""
+    transport = "websockets" if use_ws else "tcp"
+    port = BROKER_WS_PORT if use_ws else BROKER_PORT
+    key = (BROKER_HOST, port, transport)
+    loop = asyncio.get_running_loop()
+    
+    helper = _clients.get(key)
+    if helper is not None and helper.loop is loop:
+        return helper.client, True
+    
+    # Create MQTT client (WebSocket transport con --ws)
+    # MQTT 3.1.1 esplicito: le feature v5 non servono, niente parsing delle properties
+    client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, transport=transport, protocol=mqtt.MQTTv311)
+    if use_ws:
+        # Set WebSocket path
+        client.ws_set_options(path="/mqtt")
+    _clients[key] = _AsyncioHelper(loop, client)
+    return client, False
+
+async def _close_clients():
+    """Chiude le connessioni condivise (legate all'event loop corrente)"""
+    for helper in _clients.values():
+        if helper.client.is_connected():
+            helper.client.disconnect()
+            try:
+                await asyncio.wait_for(helper.closed.wait(), 1.0)
+            except asyncio.TimeoutError:
+                pass
+    _clients.clear()
+
+async def test_emqx_connection(use_ws=False, count=1, verbose=False, qos=0):
     """Test connessione al broker EMQX pubblico"""
     
-    broker_url = "ws://broker.emqx.io:8083/mqtt"
-    topic_prefix = "security1/esp32_test"
+    # TCP diretto di default: niente framing/masking WebSocket per messaggio
+    if use_ws:
+        broker_url = f"ws://{BROKER_HOST}:{BROKER_WS_PORT}/mqtt"
+    else:
+        broker_url = f"mqtt://{BROKER_HOST}:{BROKER_PORT}"
     
-    print(f"🧪 Testing MQTT WebSocket connection")
+    print(f"🧪 Testing MQTT {'WebSocket' if use_ws else 'TCP'} connection")
     print(f"Broker: {broker_url}")
-    print(f"Topic: {topic_prefix}")
+    print(f"Topic: {TOPIC_PREFIX}")
     print("-" * 50)
     
-    messages_received = []
+    # Payload ricevuti in un unico buffer, framing [len u32 BE][payload]
+    messages_log = bytearray()
+    messages_count = 0
+    done = asyncio.Event()  # echo ricevuto o connessione rifiutata
+    publish_stats = {"pending": set(), "acked": 0, "start": 0.0, "end": 0.0}
+    all_published = asyncio.Event()  # tutti i mid confermati da on_publish
+    connect_rc = None  # reason code del CONNACK, None finché non arriva
     
     def on_connect(client, userdata, flags, rc, properties=None):
+        nonlocal connect_rc
+        connect_rc = rc
         if rc == 0:
             print("✅ Connected to MQTT broker")
             
             # Subscribe to test topic
-            test_topic = f"{topic_prefix}/test/response"
-            client.subscribe(test_topic)
-            print(f"📋 Subscribed to: {test_topic}")
+            client.subscribe(SUB_TOPIC)
+            print(f"📋 Subscribed to: {SUB_TOPIC}")
             
-            # Publish test message
-            test_msg = {
-                "test": "mqtt_connection",
-                "timestamp": time.time(),
-                "message": "Hello from Python test client!"
-            }
+            # Publish test message (stesso payload per tutto il batch).
+            # Default: 1 byte, timestamp nel topic -> un solo segmento/frame.
+            # Con --verbose il messaggio JSON completo
+            if verbose:
+                payload = _test_payload()
+                publish_topic = PUB_TOPIC
+            else:
+                payload = b"1"
+                publish_topic = f"{PUB_TOPIC}/{int(time.time())}"
+            payload = _maybe_compress(payload)  # solo oltre COMPRESS_THRESHOLD
             
-            publish_topic = f"{topic_prefix}/test/request"
-            client.publish(publish_topic, json.dumps(test_msg))
-            print(f"📤 Published test message to: {publish_topic}")
+            # QoS 0 di default: attendere un PUBACK per messaggio (QoS 1/2)
+            # può costare gran parte del throughput. Anche con --qos 1/2 i
+            # publish non si attendono uno per uno: i mid vengono raccolti e
+            # confermati in blocco a fine test
+            publish_stats["start"] = time.perf_counter()
+            for _ in range(count):
+                publish_stats["pending"].add(client.publish(publish_topic, payload, qos=qos).mid)
+            print(f"📤 Published {count} test message(s) to: {publish_topic}")
             
         else:
             print(f"❌ Failed to connect, return code {rc}")
+            done.set()
+    
+    # Decodifica e stampa dei messaggi su un thread a parte: la callback
+    # di rete torna subito e non resta indietro sui burst
+    log_queue = queue.SimpleQueue()
+    
+    def format_messages():
+        while (item := log_queue.get()) is not None:
+            topic, raw = item
+            raw = _maybe_decompress(raw)
+            print(f"📨 Message received on {topic}:")
+            try:
+                payload = _json_loads(raw)
+            except _JSONDecodeError:
+                print(f"   Raw: {raw[:256]}")  # payload non JSON: dump troncato
+            else:
+                print(f"   {_json_pretty(payload)}")
+    
+    formatter = threading.Thread(target=format_messages, daemon=True)
+    formatter.start()
     
     def on_message(client, userdata, msg, properties=None):
-        print(f"📨 Message received on {msg.topic}:")
-        try:
-            payload = json.loads(msg.payload.decode())
-            print(f"   {json.dumps(payload, indent=2)}")
-        except:
-            print(f"   Raw: {msg.payload}")
-        messages_received.append(msg.payload)
+        nonlocal messages_count, messages_log
+        messages_count += 1
+        messages_log += len(msg.payload).to_bytes(4, "big")
+        messages_log += msg.payload
+        log_queue.put((msg.topic, msg.payload))
+        done.set()
+    
+    def on_publish(client, userdata, mid, reason_code=None, properties=None):
+        if mid in publish_stats["pending"]:
+            publish_stats["pending"].discard(mid)
+            publish_stats["acked"] += 1
+            publish_stats["end"] = time.perf_counter()
+            if not publish_stats["pending"]:
+                all_published.set()
     
-    def on_disconnect(client, userdata, rc, properties=None):
+    def on_disconnect(client, userdata, flags, rc, properties=None):
         print(f"🔌 Disconnected from broker (rc={rc})")
     
     try:
-        # Create MQTT client with WebSocket transport
-        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, transport="websockets")
+        client, reused = _get_client(use_ws)
         
-        # Set WebSocket path
-        client.ws_set_options(path="/mqtt")
-        
-        # Set callbacks
+        # Set callbacks (legati a questo run)
         client.on_connect = on_connect
         client.on_message = on_message
+        client.on_publish = on_publish
         client.on_disconnect = on_disconnect
         
-        # Connect to broker
-        print("🔌 Connecting to broker...")
-        client.connect("broker.emqx.io", 8083, 60)
-        
-        # Start network loop
-        client.loop_start()
+        if reused and client.is_connected():
+            # Connessione già aperta da un run precedente: niente handshake
+            print("🔁 Reusing open MQTT connection")
+            on_connect(client, None, None, 0)
+        elif reused:
+            print("🔌 Reconnecting to broker...")
+            client.reconnect()
+        else:
+            # Connect to broker
+            print("🔌 Connecting to broker...")
+            client.connect(BROKER_HOST, BROKER_WS_PORT if use_ws else BROKER_PORT, 60)
         
-        # Wait for messages
+        # Wait for messages (la connessione resta aperta, chiusa da _close_clients)
         print("⏳ Waiting for test completion...")
-        time.sleep(5.0)
+        timeout = asyncio.get_running_loop().call_later(5.0, done.set)
+        try:
+            await done.wait()
+        finally:
+            timeout.cancel()
         
-        # Cleanup
-        client.loop_stop()
-        client.disconnect()
+        # Connessione rifiutata o CONNACK mai arrivato: inutile attendere i publish
+        if connect_rc is None or connect_rc != 0:
+            log_queue.put(None)
+            if connect_rc is None:
+                print("❌ No CONNACK from broker within 5s")
+            return False
+        
+        # Conferma in blocco dei publish ancora in volo (PUBACK/PUBCOMP con QoS 1/2)
+        if publish_stats["pending"]:
+            timeout = asyncio.get_running_loop().call_later(5.0, all_published.set)
+            try:
+                await all_published.wait()
+            finally:
+                timeout.cancel()
+        
+        # Svuota il log dei messaggi prima del riepilogo
+        log_queue.put(None)
+        await asyncio.to_thread(formatter.join)
         
         print("\n" + "="*50)
         print("🏁 Test Results:")
-        print(f"Messages received: {len(messages_received)}")
+        print(f"Messages published: {publish_stats['acked']}/{count}")
+        if count > 1 and publish_stats["acked"]:
+            elapsed = publish_stats["end"] - publish_stats["start"]
+            print(f"Publish throughput: {publish_stats['acked'] / elapsed:.0f} msg/s" if elapsed else "Publish throughput: n/a")
+        print(f"Messages received: {messages_count} ({len(messages_log) - 4 * messages_count} bytes)")
         
-        if len(messages_received) > 0:
-            print("✅ MQTT WebSocket connection working!")
+        if messages_count > 0:
+            print(f"✅ MQTT {'WebSocket' if use_ws else 'TCP'} connection working!")
         else:
             print("⚠️ No echo received (normal for public broker)")
             print("✅ Connection established successfully")
@@ -101,5 +320,23 @@ def test_emqx_connection():
         return False
 
 if __name__ == "__main__":
-    success = test_emqx_connection()
+    parser = argparse.ArgumentParser(description="Quick MQTT connection test")
+    parser.add_argument("--ws", action="store_true", help="Usa il transport WebSocket (porta 8083)")
+    parser.add_argument("--count", type=int, default=1, metavar="N",
+                        help="Pubblica N messaggi in raffica per misurare il throughput")
+    parser.add_argument("--qos", type=int, default=0, choices=[0, 1, 2],
+                        help="QoS dei publish di test (default 0)")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Pubblica il messaggio di test JSON completo invece del payload da 1 byte")
+    args = parser.parse_args()
+    
+    async def main():
+        try:
+            return await test_emqx_connection(use_ws=args.ws, count=args.count, verbose=args.verbose, qos=args.qos)
+        finally:
+            await _close_clients()
+    
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    success = asyncio.run(main())
     exit(0 if success else 1)
\ No newline at end of file
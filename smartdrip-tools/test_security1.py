@@ -6,7 +6,8 @@ Test script per verificare l'handshake Security1 su BLE e MQTT
 dell'ESP32 firmware con protocomm e crittografia X25519 + AES-CTR.
 
 Dipendenze:
-pip install bleak paho-mqtt cryptography pyserial
+pip install bleak "aiomqtt>=2.0.0" cryptography pyserial
+(oppure: pip install -r requirements.txt)
 
 Utilizzo:
 python test_security1.py --transport ble --device "ESP32_Security1"
@@ -16,38 +17,56 @@ python test_security1.py --transport both --device "ESP32_Security1" --broker "1
 
 import asyncio
 import argparse
+import functools
+import hashlib
+import importlib.util
 import json
 import time
 import logging
 import struct
+import sys
 import uuid
+from collections import Counter
+from contextlib import AsyncExitStack, asynccontextmanager
+from urllib.parse import urlparse
 from typing import Optional, Dict, Any
-from dataclasses import dataclass
+from dataclasses import dataclass, fields
 from enum import Enum
 
+# Trasporti importati solo al primo uso: qui si verifica soltanto che ci siano,
+# cosi' un run solo MQTT non paga l'import di bleak (e viceversa)
+BleakClient = BleakScanner = None
+aiomqtt = None
+
 # BLE Dependencies
-try:
-    from bleak import BleakClient, BleakScanner
-    BLE_AVAILABLE = True
-except ImportError:
+BLE_AVAILABLE = importlib.util.find_spec("bleak") is not None
+if not BLE_AVAILABLE:
     print("⚠️ BLE support not available. Install with: pip install bleak")
-    BLE_AVAILABLE = False
 
-# MQTT Dependencies  
-try:
-    import paho.mqtt.client as mqtt
-    MQTT_AVAILABLE = True
-except ImportError:
-    print("⚠️ MQTT support not available. Install with: pip install paho-mqtt")
-    MQTT_AVAILABLE = False
+# MQTT Dependencies (aiomqtt: paho sull'event loop asyncio, niente thread di rete)
+MQTT_AVAILABLE = importlib.util.find_spec("aiomqtt") is not None
+if not MQTT_AVAILABLE:
+    print("⚠️ MQTT support not available. Install with: pip install aiomqtt")
 
 # WebSocket support for MQTT
-try:
-    import websocket
-    WEBSOCKET_AVAILABLE = True
-except ImportError:
+WEBSOCKET_AVAILABLE = importlib.util.find_spec("websocket") is not None
+if not WEBSOCKET_AVAILABLE:
     print("⚠️ WebSocket support not available. Install with: pip install websocket-client")
-    WEBSOCKET_AVAILABLE = False
+
+
+def _load_ble():
+    """Importa bleak al primo uso"""
+    global BleakClient, BleakScanner
+    if BleakClient is None:
+        from bleak import BleakClient, BleakScanner
+
+
+def _load_mqtt():
+    """Importa aiomqtt al primo uso"""
+    global aiomqtt
+    if aiomqtt is None:
+        import aiomqtt
+
 
 # Crypto Dependencies
 try:
@@ -55,6 +74,7 @@ try:
     from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
     from cryptography.hazmat.primitives.kdf.hkdf import HKDF
     from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
     from cryptography.hazmat.primitives import hmac
     import secrets
     CRYPTO_AVAILABLE = True
@@ -62,13 +82,27 @@ except ImportError:
     print("⚠️ Crypto support not available. Install with: pip install cryptography")
     CRYPTO_AVAILABLE = False
 
-def long_to_bytes(val):
-    """Helper function from ESP-IDF"""
-    return val.to_bytes(1, 'big')
+# JSON veloce, opzionale
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Serializzatori risolti una volta sola: bytes in uscita, bytes accettati in ingresso
+if orjson is not None:
+    _json_bytes = orjson.dumps
+    _json_loads = orjson.loads
+else:
+    _json_loads = json.loads  # accetta bytes anche lui
+    _JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+    def _json_bytes(obj) -> bytes:
+        return _JSON_ENCODER.encode(obj).encode()
 
 def a_xor_b(a: bytes, b: bytes) -> bytes:
-    """XOR function from ESP-IDF security1.py"""
-    return b''.join(long_to_bytes(a[i] ^ b[i]) for i in range(0, len(b)))
+    """XOR function from ESP-IDF security1.py (primi len(b) byte di a), in un'unica operazione su interi"""
+    n = len(b)
+    return (int.from_bytes(a[:n], 'big') ^ int.from_bytes(b, 'big')).to_bytes(n, 'big')
 
 # ==================== CONSTANTS ====================
 
@@ -87,6 +121,17 @@ SECURITY1_SESSION_ESTABLISH = 0x01
 SECURITY1_SESSION_VERIFY = 0x02
 SECURITY1_SESSION_DATA = 0x03
 
+# Risposte trattenute per step: ne serve una, il resto è rumore (es. broker condiviso)
+_MAX_PENDING_RESPONSES = 4
+
+# Layout dei messaggi Security1, compilati una volta
+_ESTABLISH_MSG = struct.Struct("<BBB32s")  # version + type + key_len + client_public_key
+_MSG_HDR = struct.Struct("<BBB")           # version + type + key_len/status
+_VERIFY_HDR = struct.Struct(">BBH")        # version + type + token_len, seguito dal token
+
+# Porte di default per MQTT su WebSocket
+_WS_DEFAULT_PORTS = {"ws": 8083, "wss": 8084}
+
 class TestResult(Enum):
     PENDING = "⏳"
     SUCCESS = "✅"
@@ -103,14 +148,44 @@ class Security1Session:
     session_active: bool = False
     proof_of_possession: str = "test_pop_12345"  # Default, overridden by constructor
 
+@dataclass
+class Security1Results:
+    """Esito per test; PENDING = non eseguito"""
+    ble_discovery: TestResult = TestResult.PENDING
+    ble_handshake: TestResult = TestResult.PENDING
+    ble_encrypted_comm: TestResult = TestResult.PENDING
+    mqtt_connection: TestResult = TestResult.PENDING
+    mqtt_handshake: TestResult = TestResult.PENDING
+    mqtt_encrypted_comm: TestResult = TestResult.PENDING
+    
+    def executed(self) -> list[tuple[str, TestResult]]:
+        """(nome, esito) dei test eseguiti, in ordine di dichiarazione"""
+        return [(f.name, r) for f in fields(self) if (r := getattr(self, f.name)) is not TestResult.PENDING]
+
+# Etichette per il riepilogo, calcolate una volta dai nomi dei campi
+_RESULT_LABELS = {f.name: f.name.replace('_', ' ').title() for f in fields(Security1Results)}
+
 class Security1Tester:
     """Test suite completa per Security1 handshake"""
     
-    def __init__(self, verbose: bool = True, pop: str = "test_pop_12345"):
+    def __init__(self, verbose: bool = True, pop: str = "test_pop_12345", aead: bool = False):
         self.verbose = verbose
+        self.aead = aead  # AES-GCM al posto di AES-CTR + HMAC (richiede firmware compatibile)
         self.session = Security1Session()
         self.session.proof_of_possession = pop  # Override default PoP
-        self.results: Dict[str, TestResult] = {}
+        self.results = Security1Results()
+        self._pop_digest: Optional[tuple[str, bytes]] = None  # (PoP, SHA256(PoP)) in cache
+        if pop:
+            self._pop_sha256(pop)  # la PoP è costante per il tester: digest calcolato subito
+        self._aes_algo = None  # algorithms.AES(session_key), creato una volta per sessione
+        self._aesgcm: Optional[tuple[bytes, Any]] = None  # (session_key, AESGCM) in cache
+        self._hmac_base: Optional[tuple[bytes, Any]] = None  # (session_key, HMAC già inizializzato)
+        self._ble_client = None  # BleakClient condiviso tra handshake e test operativi
+        self._mqtt = None  # aiomqtt.Client condiviso tra i test MQTT
+        self._mqtt_url: Optional[str] = None
+        self._mqtt_stack: Optional[AsyncExitStack] = None
+        self._mqtt_router: Optional[asyncio.Task] = None
+        self._mqtt_queues: Dict[str, asyncio.Queue] = {}  # topic -> payload in arrivo
         
         # Setup logging
         level = logging.DEBUG if verbose else logging.INFO
@@ -145,6 +220,7 @@ class Security1Tester:
             encoding=serialization.Encoding.Raw,
             format=serialization.PublicFormat.Raw
         )
+        assert len(public_key_bytes) == 32  # X25519 raw: sempre 32 byte, nessun padding necessario
         
         self.log(f"Generated client keypair with deterministic compatibility (public: {public_key_bytes.hex()[:16]}...)")
         return public_key_bytes
@@ -168,6 +244,12 @@ class Security1Tester:
         self.log(f"🔍 REAL X25519 shared secret computed: {shared_secret.hex()}")
         return shared_secret
     
+    def _pop_sha256(self, pop: str) -> bytes:
+        """SHA256(PoP), ricalcolato solo se la PoP cambia"""
+        if self._pop_digest is None or self._pop_digest[0] != pop:
+            self._pop_digest = (pop, hashlib.sha256(pop.encode('utf-8')).digest())
+        return self._pop_digest[1]
+    
     def derive_session_key_authentic(self, pop: str) -> bytes:
         """Deriva session key con protocollo Security1 autentico: curve25519_result XOR SHA256(PoP)"""
         if not self.session.shared_secret:
@@ -177,26 +259,48 @@ class Security1Tester:
         
         # Step 1: Start with the shared secret (ESP-IDF pattern)
         sharedK = self.session.shared_secret
-        self.log(f"Shared Key: {sharedK.hex()}", "debug")
+        if self.verbose:
+            self.log(f"Shared Key: {sharedK.hex()}", "debug")
         
         # Step 2: If PoP is provided, XOR SHA256 of PoP with the shared key (ESP-IDF pattern)
         if len(pop) > 0:
-            # Calculate SHA256 of PoP
-            pop_hash = hashes.Hash(hashes.SHA256())
-            pop_hash.update(pop.encode('utf-8'))
-            digest = pop_hash.finalize()
-            self.log(f"SHA256(PoP): {digest.hex()[:16]}...", "debug")
+            # Calculate SHA256 of PoP (una volta per PoP, riusato tra handshake)
+            digest = self._pop_sha256(pop)
+            if self.verbose:
+                self.log(f"SHA256(PoP): {digest[:8].hex()}...", "debug")
             
             # XOR with and update Shared Key (using ESP-IDF a_xor_b function)
             sharedK = a_xor_b(sharedK, digest)
-            self.log(f"Updated Shared Key (Shared key XORed with PoP): {sharedK.hex()[:16]}...", "debug")
+            if self.verbose:
+                self.log(f"Updated Shared Key (Shared key XORed with PoP): {sharedK[:8].hex()}...", "debug")
         
         self.session.session_key = sharedK
         self.session.session_active = True
+        self._aes_algo = algorithms.AES(sharedK)
         
         self.log(f"ESP-IDF session key derived: {sharedK.hex()[:16]}...", "success")
         return sharedK
     
+    def _aes(self, key: bytes):
+        """algorithms.AES per key, riusando quello della sessione se la chiave coincide"""
+        if self._aes_algo is not None and self._aes_algo.key == key:
+            return self._aes_algo
+        return algorithms.AES(key)
+    
+    def _gcm(self):
+        """AESGCM per la session key corrente, ricreato solo se la chiave cambia"""
+        key = self.session.session_key
+        if self._aesgcm is None or self._aesgcm[0] != key:
+            self._aesgcm = (key, AESGCM(key))
+        return self._aesgcm[1]
+    
+    def _hmac(self):
+        """HMAC-SHA256 per la session key: copia di un contesto con la chiave già caricata"""
+        key = self.session.session_key
+        if self._hmac_base is None or self._hmac_base[0] != key:
+            self._hmac_base = (key, hmac.HMAC(key, hashes.SHA256()))
+        return self._hmac_base[1].copy()
+    
     def generate_verification_token_aes_ctr(self, device_public_key: bytes, device_random: bytes, session_key: bytes) -> bytes:
         """Genera verification token AUTENTICO con AES-CTR come da protocollo ESP-IDF Security1"""
         self.log(f"Generating AUTHENTIC AES-CTR verification token", "info")
@@ -204,11 +308,9 @@ class Security1Tester:
         # Protocollo ESP-IDF Security1: client_verify = AES_CTR_encrypt(device_public_key, session_key, device_random_IV)
         # Reference: /Users/bogie/esp/esp-idf/tools/esp_prov/security/security1.py lines 114-116
         
-        from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
-        
         # Initialize AES-CTR cipher using session_key as key and device_random as IV
         cipher = Cipher(
-            algorithms.AES(session_key), 
+            self._aes(session_key), 
             modes.CTR(device_random)
         )
         encryptor = cipher.encryptor()
@@ -216,11 +318,12 @@ class Security1Tester:
         # Encrypt device_public_key to create verification token
         verification_token = encryptor.update(device_public_key) + encryptor.finalize()
         
-        self.log(f"AES-CTR verification inputs:", "debug")
-        self.log(f"  Device public key: {device_public_key.hex()}", "debug")
-        self.log(f"  Session key: {session_key.hex()}", "debug") 
-        self.log(f"  Device random (IV): {device_random.hex()}", "debug")
-        self.log(f"  Verification token: {verification_token.hex()}", "debug")
+        if self.verbose:
+            self.log("AES-CTR verification inputs:", "debug")
+            self.log(f"  Device public key: {device_public_key.hex()}", "debug")
+            self.log(f"  Session key: {session_key.hex()}", "debug")
+            self.log(f"  Device random (IV): {device_random.hex()}", "debug")
+            self.log(f"  Verification token: {verification_token.hex()}", "debug")
         
         return verification_token
     
@@ -228,25 +331,33 @@ class Security1Tester:
         """Critta dati con AES-CTR usando session key"""
         if not self.session.session_key:
             raise ValueError("Session key not available")
+        
+        if self.aead:
+            # AES-GCM: cifratura e autenticazione in un solo passaggio
+            # Formato: IV (12) + Ciphertext + Tag (16)
+            iv = secrets.token_bytes(12)
+            encrypted_data = iv + self._gcm().encrypt(iv, plaintext, None)
+            self.log(f"Encrypted {len(plaintext)} bytes → {len(encrypted_data)} bytes")
+            return encrypted_data
             
         # Genera IV random
         iv = secrets.token_bytes(16)
         
         # AES-CTR encryption
         cipher = Cipher(
-            algorithms.AES(self.session.session_key),
+            self._aes(self.session.session_key),
             modes.CTR(iv)
         )
-        encryptor = cipher.encryptor()
-        ciphertext = encryptor.update(plaintext) + encryptor.finalize()
+        ciphertext = cipher.encryptor().update(plaintext)  # CTR: finalize() non aggiunge byte
         
         # HMAC per integrità
-        h = hmac.HMAC(self.session.session_key, hashes.SHA256())
-        h.update(iv + ciphertext)
+        h = self._hmac()
+        h.update(iv)
+        h.update(ciphertext)
         mac = h.finalize()
         
-        # Formato: IV (16) + MAC (32) + Ciphertext
-        encrypted_data = iv + mac + ciphertext
+        # Formato: IV (16) + MAC (32) + Ciphertext, assemblato con una sola copia
+        encrypted_data = b"".join((iv, mac, ciphertext))
         
         self.log(f"Encrypted {len(plaintext)} bytes → {len(encrypted_data)} bytes")
         return encrypted_data
@@ -255,171 +366,182 @@ class Security1Tester:
         """Decritta dati ricevuti"""
         if not self.session.session_key:
             raise ValueError("Session key not available")
+        
+        if self.aead:
+            if len(encrypted_data) < 28:  # IV + tag minimum
+                raise ValueError("Encrypted data too short")
+            mv = memoryview(encrypted_data)
+            plaintext = self._gcm().decrypt(mv[:12], mv[12:], None)
+            self.log(f"Decrypted {len(encrypted_data)} bytes → {len(plaintext)} bytes")
+            return plaintext
             
         if len(encrypted_data) < 48:  # IV + MAC minimum
             raise ValueError("Encrypted data too short")
             
-        # Estrai componenti
-        iv = encrypted_data[:16]
-        mac = encrypted_data[16:48]
-        ciphertext = encrypted_data[48:]
+        # Estrai componenti (view, nessuna copia)
+        mv = memoryview(encrypted_data)
+        iv = mv[:16]
+        mac = bytes(mv[16:48])
+        ciphertext = mv[48:]
         
         # Verifica HMAC
-        h = hmac.HMAC(self.session.session_key, hashes.SHA256())
-        h.update(iv + ciphertext)
+        h = self._hmac()
+        h.update(iv)
+        h.update(ciphertext)
         h.verify(mac)
         
-        # AES-CTR decryption
+        # AES-CTR decryption (stream cipher: finalize() non produce altri byte)
         cipher = Cipher(
-            algorithms.AES(self.session.session_key),
+            self._aes(self.session.session_key),
             modes.CTR(iv)
         )
-        decryptor = cipher.decryptor()
-        plaintext = decryptor.update(ciphertext) + decryptor.finalize()
+        plaintext = cipher.decryptor().update(ciphertext)
         
         self.log(f"Decrypted {len(encrypted_data)} bytes → {len(plaintext)} bytes")
         return plaintext
 
     # ==================== URL PARSING HELPER ====================
     
-    def parse_mqtt_websocket_url(self, broker_url: str) -> tuple[str, int, str]:
-        """Parse WebSocket MQTT URL and return (host, port, path)"""
-        if broker_url.startswith("ws://"):
-            # Parse ws://broker.emqx.io:8083/mqtt
-            url_without_protocol = broker_url.replace("ws://", "")  # broker.emqx.io:8083/mqtt
-            if ":" in url_without_protocol:
-                broker_host = url_without_protocol.split(":")[0]  # broker.emqx.io
-                port_and_path = url_without_protocol.split(":", 1)[1]  # 8083/mqtt
-                if "/" in port_and_path:
-                    broker_port = int(port_and_path.split("/")[0])  # 8083
-                    ws_path = "/" + "/".join(port_and_path.split("/")[1:])  # /mqtt
-                else:
-                    broker_port = int(port_and_path)
-                    ws_path = "/mqtt"
-            else:
-                broker_host = url_without_protocol.split("/")[0]
-                broker_port = 8083
-                ws_path = "/" + "/".join(url_without_protocol.split("/")[1:])
-        elif broker_url.startswith("wss://"):
-            # Parse wss://secure.broker.com:8084/mqtt  
-            url_without_protocol = broker_url.replace("wss://", "")
-            if ":" in url_without_protocol:
-                broker_host = url_without_protocol.split(":")[0]
-                port_and_path = url_without_protocol.split(":", 1)[1]
-                if "/" in port_and_path:
-                    broker_port = int(port_and_path.split("/")[0])
-                    ws_path = "/" + "/".join(port_and_path.split("/")[1:])
-                else:
-                    broker_port = int(port_and_path)
-                    ws_path = "/mqtt"
-            else:
-                broker_host = url_without_protocol.split("/")[0]
-                broker_port = 8084
-                ws_path = "/" + "/".join(url_without_protocol.split("/")[1:])
-        else:
-            # Fallback to standard MQTT
-            broker_host = broker_url
-            broker_port = 1883
-            ws_path = None
-            
-        return broker_host, broker_port, ws_path
+    @staticmethod
+    @functools.lru_cache(maxsize=4)
+    def parse_mqtt_websocket_url(broker_url: str) -> tuple[str, int, str]:
+        """Parse WebSocket MQTT URL and return (host, port, path), memoized per URL"""
+        url = urlparse(broker_url)
+        
+        if url.scheme in _WS_DEFAULT_PORTS:
+            # ws://broker.emqx.io:8083/mqtt, wss://secure.broker.com:8084/mqtt
+            return url.hostname, url.port or _WS_DEFAULT_PORTS[url.scheme], url.path or "/mqtt"
+        
+        # Fallback to standard MQTT
+        return url.hostname or broker_url, url.port or 1883, None
 
     # ==================== BLE TESTING ====================
     
     async def test_ble_discovery(self, device_name: str) -> Optional[str]:
         """Scopre dispositivi BLE con Security1"""
         if not BLE_AVAILABLE:
-            self.results["ble_discovery"] = TestResult.SKIPPED
+            self.results.ble_discovery = TestResult.SKIPPED
             return None
             
         self.log(f"🔍 Scanning for BLE device: {device_name}")
         
         try:
-            devices = await BleakScanner.discover(timeout=10.0)
+            # Import al primo uso: un bleak rotto fallisce la discovery, non l'intero run
+            _load_ble()
             
-            for device in devices:
-                if device.name and device_name.lower() in device.name.lower():
-                    self.log(f"Found device: {device.name} ({device.address})", "success")
-                    self.results["ble_discovery"] = TestResult.SUCCESS
-                    return device.address
+            # Lo scan si ferma al primo advertising che corrisponde
+            wanted = device_name.lower()
+            device = await BleakScanner.find_device_by_filter(
+                lambda d, adv: bool(d.name) and wanted in d.name.lower(),
+                timeout=10.0
+            )
+            
+            if device:
+                self.log(f"Found device: {device.name} ({device.address})", "success")
+                self.results.ble_discovery = TestResult.SUCCESS
+                return device.address
                     
             self.log(f"Device '{device_name}' not found", "error")
-            self.results["ble_discovery"] = TestResult.FAILED
+            self.results.ble_discovery = TestResult.FAILED
             return None
             
         except Exception as e:
             self.log(f"BLE discovery failed: {e}", "error")
-            self.results["ble_discovery"] = TestResult.FAILED
+            self.results.ble_discovery = TestResult.FAILED
             return None
     
+    @staticmethod
+    async def _wait_event(event: asyncio.Event, timeout: float) -> bool:
+        """Attende che il notify handler segnali una risposta, False su timeout"""
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+    
+    @asynccontextmanager
+    async def _ble_connection(self, device_address: str):
+        """Riusa la connessione BLE aperta da run_ble_tests, altrimenti ne apre una"""
+        if self._ble_client is not None and self._ble_client.is_connected:
+            yield self._ble_client
+            return
+        _load_ble()
+        async with BleakClient(device_address) as client:
+            yield client
+    
     async def test_ble_handshake(self, device_address: str) -> bool:
         """Test completo handshake Security1 su BLE"""
         if not BLE_AVAILABLE or not CRYPTO_AVAILABLE:
-            self.results["ble_handshake"] = TestResult.SKIPPED
+            self.results.ble_handshake = TestResult.SKIPPED
             return False
             
         self.log(f"🤝 Starting BLE Security1 handshake with {device_address}")
         
         try:
-            async with BleakClient(device_address) as client:
+            async with self._ble_connection(device_address) as client:
                 self.log("Connected to BLE device")
                 
-                # Verifica servizi disponibili
-                services = await client.get_services()
-                handshake_service = None
-                
-                for service in services:
-                    if service.uuid.lower() == BLE_HANDSHAKE_SERVICE_UUID.lower():
-                        handshake_service = service
-                        self.log(f"Found handshake service: {service.uuid}")
-                        break
+                # Verifica servizi disponibili (già scoperti da Bleak alla connessione)
+                handshake_service = client.services.get_service(BLE_HANDSHAKE_SERVICE_UUID)
                 
                 if not handshake_service:
                     self.log("Handshake service not found", "error")
-                    self.results["ble_handshake"] = TestResult.FAILED
+                    self.results.ble_handshake = TestResult.FAILED
+                    return False
+                
+                self.log(f"Found handshake service: {handshake_service.uuid}")
+                tx_char = handshake_service.get_characteristic(BLE_HANDSHAKE_TX_CHAR_UUID)
+                rx_char = handshake_service.get_characteristic(BLE_HANDSHAKE_RX_CHAR_UUID)
+                
+                if not tx_char or not rx_char:
+                    self.log("Handshake characteristics not found", "error")
+                    self.results.ble_handshake = TestResult.FAILED
                     return False
                 
                 # Setup notifiche su RX characteristic
                 rx_responses = []
+                response_event = asyncio.Event()
                 
                 def notification_handler(characteristic, data):
                     self.log(f"Received notification: {data.hex()}")
-                    rx_responses.append(data)
+                    # Buffer pieno: si scartano le nuove, la prima risposta (letta con [0]) resta
+                    if len(rx_responses) < _MAX_PENDING_RESPONSES:
+                        rx_responses.append(data)
+                    response_event.set()
                 
-                await client.start_notify(BLE_HANDSHAKE_RX_CHAR_UUID, notification_handler)
+                await client.start_notify(rx_char, notification_handler)
                 
                 # Step 1: Invia SESSION_ESTABLISH con chiave pubblica client
                 client_public_key = self.generate_client_keypair()
                 
-                establish_msg = struct.pack(
-                    "<BBB32s", 
+                establish_msg = _ESTABLISH_MSG.pack(
                     SECURITY1_VERSION, 
                     SECURITY1_SESSION_ESTABLISH, 
                     len(client_public_key),
-                    client_public_key.ljust(32, b'\x00')
+                    client_public_key
                 )
                 
                 self.log(f"Sending SESSION_ESTABLISH ({len(establish_msg)} bytes)")
-                await client.write_gatt_char(BLE_HANDSHAKE_TX_CHAR_UUID, establish_msg)
+                await client.write_gatt_char(tx_char, establish_msg)
                 
                 # Attendi risposta server
-                await asyncio.sleep(2.0)
+                await self._wait_event(response_event, 5.0)
                 
                 if not rx_responses:
                     self.log("No response from server", "error")
-                    self.results["ble_handshake"] = TestResult.FAILED
+                    self.results.ble_handshake = TestResult.FAILED
                     return False
                 
                 # Parse risposta server
-                server_response = rx_responses[0]
+                server_response = memoryview(rx_responses[0])  # slice senza copie
                 # Parse AUTHENTIC Security1 response: version + type + key_len + device_public_key(32) + device_random(16)
                 if len(server_response) < 51:  # Expected: 3 + 32 + 16 = 51 bytes
                     self.log(f"Invalid server response length: {len(server_response)}, expected 51", "error")
-                    self.results["ble_handshake"] = TestResult.FAILED
+                    self.results.ble_handshake = TestResult.FAILED
                     return False
                 
-                version, msg_type, key_len = struct.unpack("<BBB", server_response[:3])
-                server_public_key = server_response[3:3+key_len]  # bytes 3-35
+                version, msg_type, key_len = _MSG_HDR.unpack_from(server_response)
+                server_public_key = bytes(server_response[3:3+key_len])  # bytes 3-35, X25519 vuole bytes
                 device_random = server_response[3+key_len:3+key_len+16]  # bytes 35-51
                 
                 self.log(f"Server response: version={version}, type={msg_type}, key_len={key_len}")
@@ -440,56 +562,66 @@ class Security1Tester:
                 self.log(f"Generated AUTHENTIC AES-CTR verification token: {verification_token.hex()}")
                 pop_encrypted = verification_token
                 
-                verify_msg = struct.pack(
-                    f">BBH{len(pop_encrypted)}s",
+                verify_msg = _VERIFY_HDR.pack(
                     SECURITY1_VERSION,
                     SECURITY1_SESSION_VERIFY,
-                    len(pop_encrypted),
-                    pop_encrypted
-                )
+                    len(pop_encrypted)
+                ) + pop_encrypted
                 
                 self.log(f"Sending SESSION_VERIFY ({len(verify_msg)} bytes)")
                 rx_responses.clear()
-                await client.write_gatt_char(BLE_HANDSHAKE_TX_CHAR_UUID, verify_msg)
+                response_event.clear()
+                await client.write_gatt_char(tx_char, verify_msg)
                 
                 # Attendi conferma
-                await asyncio.sleep(2.0)
+                await self._wait_event(response_event, 5.0)
                 
                 if rx_responses and len(rx_responses[0]) >= 3:
-                    _, msg_type, status = struct.unpack("<BBB", rx_responses[0][:3])
+                    _, msg_type, status = _MSG_HDR.unpack_from(rx_responses[0])
                     if msg_type == SECURITY1_SESSION_VERIFY and status == 0:
                         self.log("BLE Security1 handshake completed successfully!", "success")
-                        self.results["ble_handshake"] = TestResult.SUCCESS
+                        self.results.ble_handshake = TestResult.SUCCESS
                         return True
                 
                 self.log("BLE handshake verification failed", "error")
-                self.results["ble_handshake"] = TestResult.FAILED
+                self.results.ble_handshake = TestResult.FAILED
                 return False
                 
         except Exception as e:
             self.log(f"BLE handshake failed: {e}", "error")
-            self.results["ble_handshake"] = TestResult.FAILED
+            self.results.ble_handshake = TestResult.FAILED
             return False
     
     async def test_ble_encrypted_communication(self, device_address: str) -> bool:
         """Test comunicazione crittografata su servizio operativo"""
         if not self.session.session_active:
             self.log("Session not active, skipping encrypted communication test", "warning")
-            self.results["ble_encrypted_comm"] = TestResult.SKIPPED
+            self.results.ble_encrypted_comm = TestResult.SKIPPED
             return False
             
         self.log("🔒 Testing BLE encrypted communication")
         
         try:
-            async with BleakClient(device_address) as client:
+            async with self._ble_connection(device_address) as client:
+                tx_char = client.services.get_characteristic(BLE_OPERATIONAL_TX_CHAR_UUID)
+                rx_char = client.services.get_characteristic(BLE_OPERATIONAL_RX_CHAR_UUID)
+                
+                if not tx_char or not rx_char:
+                    self.log("Operational characteristics not found", "error")
+                    self.results.ble_encrypted_comm = TestResult.FAILED
+                    return False
+                
                 # Setup notifiche su servizio operativo
                 operational_responses = []
+                response_event = asyncio.Event()
                 
                 def operational_notification_handler(characteristic, data):
                     self.log(f"Operational notification: {data.hex()}")
-                    operational_responses.append(data)
+                    if len(operational_responses) < _MAX_PENDING_RESPONSES:
+                        operational_responses.append(data)
+                    response_event.set()
                 
-                await client.start_notify(BLE_OPERATIONAL_RX_CHAR_UUID, operational_notification_handler)
+                await client.start_notify(rx_char, operational_notification_handler)
                 
                 # Invia comando crittografato
                 test_command = {
@@ -497,74 +629,146 @@ class Security1Tester:
                     "id": 12345
                 }
                 
-                command_json = json.dumps(test_command)
-                encrypted_command = self.encrypt_data(command_json.encode())
+                encrypted_command = self.encrypt_data(_json_bytes(test_command))
                 
                 self.log(f"Sending encrypted command ({len(encrypted_command)} bytes)")
-                await client.write_gatt_char(BLE_OPERATIONAL_TX_CHAR_UUID, encrypted_command)
+                await client.write_gatt_char(tx_char, encrypted_command)
                 
                 # Attendi risposta crittografata
-                await asyncio.sleep(3.0)
+                await self._wait_event(response_event, 5.0)
                 
                 if operational_responses:
                     encrypted_response = operational_responses[0]
                     decrypted_response = self.decrypt_data(encrypted_response)
                     
                     try:
-                        response_json = json.loads(decrypted_response.decode())
+                        response_json = _json_loads(decrypted_response)
                         self.log(f"Decrypted response: {response_json}", "success")
-                        self.results["ble_encrypted_comm"] = TestResult.SUCCESS
+                        self.results.ble_encrypted_comm = TestResult.SUCCESS
                         return True
                     except Exception as e:
                         self.log(f"Failed to parse decrypted response: {e}", "error")
                 
-                self.results["ble_encrypted_comm"] = TestResult.FAILED
+                self.results.ble_encrypted_comm = TestResult.FAILED
                 return False
                 
         except Exception as e:
             self.log(f"BLE encrypted communication failed: {e}", "error")
-            self.results["ble_encrypted_comm"] = TestResult.FAILED
+            self.results.ble_encrypted_comm = TestResult.FAILED
             return False
 
     # ==================== MQTT TESTING ====================
     
-    def test_mqtt_connection(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt") -> bool:
+    async def _mqtt_connect(self, broker_url: str):
+        """Client MQTT condiviso tra i test, connesso una sola volta per broker"""
+        if self._mqtt is not None and self._mqtt_url == broker_url:
+            return self._mqtt
+        await self._mqtt_close()
+        _load_mqtt()
+        
+        # Parse WebSocket URL
+        broker_host, broker_port, ws_path = self.parse_mqtt_websocket_url(broker_url)
+        
+        client = aiomqtt.Client(
+            broker_host,
+            broker_port,
+            keepalive=60,
+            timeout=5.0,
+            transport="websockets" if ws_path else "tcp",
+            websocket_path=ws_path
+        )
+        
+        stack = AsyncExitStack()
+        try:
+            await stack.enter_async_context(client)
+        except aiomqtt.MqttError as e:
+            self.log(f"MQTT connect error: {e}", "debug")
+            return None
+        
+        self._mqtt, self._mqtt_url, self._mqtt_stack = client, broker_url, stack
+        self._mqtt_router = asyncio.create_task(self._route_mqtt_messages(client))
+        return client
+    
+    async def _mqtt_close(self):
+        """Chiude il client MQTT condiviso, se aperto"""
+        if self._mqtt is None:
+            return
+        self._mqtt_router.cancel()
+        await self._mqtt_stack.aclose()
+        self._mqtt = self._mqtt_url = self._mqtt_stack = self._mqtt_router = None
+        self._mqtt_queues.clear()
+    
+    async def _route_mqtt_messages(self, client):
+        """Smista i messaggi in arrivo sulla coda del topic che li attende"""
+        try:
+            async for msg in client.messages:
+                queue = self._mqtt_queues.get(msg.topic.value)
+                if queue is None:
+                    continue
+                try:
+                    queue.put_nowait(msg.payload)
+                except asyncio.QueueFull:
+                    pass  # rumore oltre le risposte attese
+        except aiomqtt.MqttError as e:
+            self.log(f"MQTT connection lost: {e}", "warning")
+    
+    async def _mqtt_subscribe(self, topic: str) -> asyncio.Queue:
+        """Sottoscrive topic sul client condiviso (attende il SUBACK), ritorna la coda dei payload"""
+        queue = self._mqtt_queues[topic] = asyncio.Queue(maxsize=_MAX_PENDING_RESPONSES)
+        await self._mqtt.subscribe(topic)
+        return queue
+    
+    async def _mqtt_unsubscribe(self, topic: str):
+        if self._mqtt_queues.pop(topic, None) is not None and self._mqtt is not None:
+            try:
+                await self._mqtt.unsubscribe(topic)
+            except aiomqtt.MqttError:
+                pass
+    
+    @staticmethod
+    def _drain(queue: asyncio.Queue):
+        """Scarta i payload rimasti in coda (risposte duplicate o in ritardo)"""
+        try:
+            while True:
+                queue.get_nowait()
+        except asyncio.QueueEmpty:
+            pass
+    
+    @staticmethod
+    async def _next_payload(queue: asyncio.Queue, timeout: float) -> Optional[bytes]:
+        """Prossimo payload dalla coda, None su timeout"""
+        try:
+            return await asyncio.wait_for(queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+    
+    async def test_mqtt_connection(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt") -> bool:
         """Test connessione MQTT broker via WebSocket"""
         if not MQTT_AVAILABLE:
-            self.results["mqtt_connection"] = TestResult.SKIPPED
+            self.results.mqtt_connection = TestResult.SKIPPED
             return False
             
         self.log(f"🌐 Testing MQTT WebSocket connection to {broker_url}")
         
         try:
-            # Parse WebSocket URL
-            broker_host, broker_port, ws_path = self.parse_mqtt_websocket_url(broker_url)
-            
-            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, transport="websockets" if ws_path else "tcp")
-            
-            # WebSocket specific configuration
-            if ws_path:
-                client.ws_set_options(path=ws_path)
-            
-            client.connect(broker_host, broker_port, 60)
-            client.loop_start()
-            time.sleep(2.0)
-            client.loop_stop()
-            client.disconnect()
+            if not await self._mqtt_connect(broker_url):
+                self.log("MQTT broker did not accept the connection", "error")
+                self.results.mqtt_connection = TestResult.FAILED
+                return False
             
             self.log("MQTT WebSocket connection successful", "success")
-            self.results["mqtt_connection"] = TestResult.SUCCESS
+            self.results.mqtt_connection = TestResult.SUCCESS
             return True
             
         except Exception as e:
             self.log(f"MQTT connection failed: {e}", "error")
-            self.results["mqtt_connection"] = TestResult.FAILED
+            self.results.mqtt_connection = TestResult.FAILED
             return False
     
-    def test_mqtt_handshake(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt", topic_prefix: str = "security1/esp32") -> bool:
+    async def test_mqtt_handshake(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt", topic_prefix: str = "security1/esp32") -> bool:
         """Test handshake Security1 su MQTT WebSocket"""
         if not MQTT_AVAILABLE or not CRYPTO_AVAILABLE:
-            self.results["mqtt_handshake"] = TestResult.SKIPPED
+            self.results.mqtt_handshake = TestResult.SKIPPED
             return False
             
         self.log(f"🤝 Starting MQTT Security1 handshake via {broker_url}")
@@ -573,65 +777,44 @@ class Security1Tester:
         handshake_request_topic = f"{topic_prefix}/handshake/request"
         handshake_response_topic = f"{topic_prefix}/handshake/response"
         
-        received_messages = []
-        
         try:
-            # Parse WebSocket URL
-            broker_host, broker_port, ws_path = self.parse_mqtt_websocket_url(broker_url)
-            
-            def on_connect(client, userdata, flags, rc, properties=None):
-                if rc == 0:
-                    self.log(f"Connected to MQTT broker, subscribing to {handshake_response_topic}")
-                    client.subscribe(handshake_response_topic)
-                else:
-                    self.log(f"Failed to connect, return code {rc}", "error")
-            
-            def on_message(client, userdata, msg, properties=None):
-                self.log(f"Received MQTT message on {msg.topic}: {len(msg.payload)} bytes")
-                received_messages.append(msg.payload)
-            
-            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, transport="websockets" if ws_path else "tcp")
-            
-            # WebSocket configuration
-            if ws_path:
-                client.ws_set_options(path=ws_path)
-            
-            client.on_connect = on_connect
-            client.on_message = on_message
-            
-            client.connect(broker_host, broker_port, 60)
-            client.loop_start()
+            client = await self._mqtt_connect(broker_url)
+            if not client:
+                self.log("Failed to connect to MQTT broker", "error")
+                self.results.mqtt_handshake = TestResult.FAILED
+                return False
             
-            # Attendi connessione
-            time.sleep(2.0)
+            self.log(f"Connected to MQTT broker, subscribing to {handshake_response_topic}")
+            responses = await self._mqtt_subscribe(handshake_response_topic)
             
             # Step 1: Invia SESSION_ESTABLISH
             client_public_key = self.generate_client_keypair()
             
-            establish_msg = struct.pack(
-                "<BBB32s", 
+            establish_msg = _ESTABLISH_MSG.pack(
                 SECURITY1_VERSION, 
                 SECURITY1_SESSION_ESTABLISH, 
                 len(client_public_key),
-                client_public_key.ljust(32, b'\x00')
+                client_public_key
             )
             
             self.log(f"Publishing SESSION_ESTABLISH to {handshake_request_topic}")
-            client.publish(handshake_request_topic, establish_msg)
+            self._drain(responses)
+            await client.publish(handshake_request_topic, establish_msg)
             
             # Attendi risposta
-            time.sleep(3.0)
+            payload = await self._next_payload(responses, 5.0)
             
-            if received_messages:
-                server_response = received_messages[0]
+            if payload is not None:
+                self.log(f"Received MQTT message on {handshake_response_topic}: {len(payload)} bytes")
+                server_response = memoryview(payload)  # slice senza copie
                 
                 # Parse AUTHENTIC Security1 response: version + type + key_len + device_public_key(32) + device_random(16)
                 if len(server_response) < 51:  # Expected: 3 + 32 + 16 = 51 bytes
                     self.log(f"Invalid server response length: {len(server_response)}, expected 51", "error")
                     return False
                     
-                version, msg_type, key_len = struct.unpack("<BBB", server_response[:3])
-                server_public_key = server_response[3:3+key_len]  # bytes 3-35
+                version, msg_type, key_len = _MSG_HDR.unpack_from(server_response)
+                server_public_key = bytes(server_response[3:3+key_len])  # bytes 3-35, X25519 vuole bytes
                 device_random = server_response[3+key_len:3+key_len+16]  # bytes 35-51
                 
                 self.log(f"Server response: version={version}, type={msg_type}, key_len={key_len}")
@@ -652,47 +835,49 @@ class Security1Tester:
                 self.log(f"Generated AUTHENTIC AES-CTR verification token: {verification_token.hex()}")
                 pop_encrypted = verification_token
                 
-                verify_msg = struct.pack(
-                    f">BBH{len(pop_encrypted)}s",
+                verify_msg = _VERIFY_HDR.pack(
                     SECURITY1_VERSION,
                     SECURITY1_SESSION_VERIFY,
-                    len(pop_encrypted),
-                    pop_encrypted
-                )
+                    len(pop_encrypted)
+                ) + pop_encrypted
                 
                 self.log(f"Publishing SESSION_VERIFY")
-                received_messages.clear()
-                client.publish(handshake_request_topic, verify_msg)
-                
-                time.sleep(3.0)
+                self._drain(responses)
+                await client.publish(handshake_request_topic, verify_msg)
                 
-                if received_messages and len(received_messages[0]) >= 3:
-                    _, msg_type, status = struct.unpack("<BBB", received_messages[0][:3])
-                    if msg_type == SECURITY1_SESSION_VERIFY and status == 0:
-                        handshake_completed = True
-            
-            client.loop_stop()
-            client.disconnect()
+                # Una risposta ESTABLISH duplicata ancora in volo arriva dopo il drain:
+                # si scartano i frame che non sono SESSION_VERIFY
+                loop = asyncio.get_running_loop()
+                deadline = loop.time() + 5.0
+                while (payload := await self._next_payload(responses, deadline - loop.time())) is not None:
+                    if len(payload) < 3:
+                        continue
+                    _, msg_type, status = _MSG_HDR.unpack_from(payload)
+                    if msg_type == SECURITY1_SESSION_VERIFY:
+                        handshake_completed = status == 0
+                        break
             
             if handshake_completed:
                 self.log("MQTT Security1 handshake completed successfully!", "success")
-                self.results["mqtt_handshake"] = TestResult.SUCCESS
+                self.results.mqtt_handshake = TestResult.SUCCESS
                 return True
             else:
                 self.log("MQTT handshake failed", "error")
-                self.results["mqtt_handshake"] = TestResult.FAILED
+                self.results.mqtt_handshake = TestResult.FAILED
                 return False
                 
         except Exception as e:
             self.log(f"MQTT handshake failed: {e}", "error")
-            self.results["mqtt_handshake"] = TestResult.FAILED
+            self.results.mqtt_handshake = TestResult.FAILED
             return False
+        finally:
+            await self._mqtt_unsubscribe(handshake_response_topic)
     
-    def test_mqtt_encrypted_communication(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt", topic_prefix: str = "security1/esp32") -> bool:
-        """Test comunicazione crittografata MQTT WebSocket"""
+    async def test_mqtt_encrypted_communication(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt", topic_prefix: str = "security1/esp32", count: int = 1) -> bool:
+        """Test comunicazione crittografata MQTT WebSocket (count comandi in pipeline)"""
         if not self.session.session_active:
             self.log("Session not active, skipping MQTT encrypted communication test", "warning")
-            self.results["mqtt_encrypted_comm"] = TestResult.SKIPPED
+            self.results.mqtt_encrypted_comm = TestResult.SKIPPED
             return False
             
         self.log("🔒 Testing MQTT encrypted communication")
@@ -700,72 +885,61 @@ class Security1Tester:
         data_request_topic = f"{topic_prefix}/data/request"
         data_response_topic = f"{topic_prefix}/data/response"
         
-        received_responses = []
+        responses: Dict[Any, Any] = {}  # id comando -> risposta decrittata
         
         try:
-            # Parse WebSocket URL
-            broker_host, broker_port, ws_path = self.parse_mqtt_websocket_url(broker_url)
-            
-            def on_connect(client, userdata, flags, rc, properties=None):
-                if rc == 0:
-                    client.subscribe(data_response_topic)
-                    self.log(f"Subscribed to {data_response_topic}")
-            
-            def on_message(client, userdata, msg, properties=None):
-                self.log(f"Received encrypted response: {len(msg.payload)} bytes")
-                received_responses.append(msg.payload)
-            
-            client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2, transport="websockets" if ws_path else "tcp")
-            
-            # WebSocket configuration
-            if ws_path:
-                client.ws_set_options(path=ws_path)
-            
-            client.on_connect = on_connect
-            client.on_message = on_message
-            
-            client.connect(broker_host, broker_port, 60)
-            client.loop_start()
-            
-            time.sleep(5.0)  # Più tempo per ESP32 operational mode
-            
-            # Invia comando crittografato
-            test_command = {
-                "op": "get_device_status",
-                "id": 67890
-            }
-            
-            command_json = json.dumps(test_command)
-            encrypted_command = self.encrypt_data(command_json.encode())
+            client = await self._mqtt_connect(broker_url)
+            if not client:
+                self.log("Failed to connect to MQTT broker", "error")
+                self.results.mqtt_encrypted_comm = TestResult.FAILED
+                return False
             
-            self.log(f"Publishing encrypted command to {data_request_topic}")
-            client.publish(data_request_topic, encrypted_command)
+            incoming = await self._mqtt_subscribe(data_response_topic)
+            self.log(f"Subscribed to {data_response_topic}")
             
-            # Attendi risposta (più tempo per debug)
-            time.sleep(8.0)
+            # Cifra tutti i comandi prima, poi li pubblica uno dietro l'altro
+            encrypted_commands = [
+                self.encrypt_data(_json_bytes({"op": "get_device_status", "id": 67890 + i}))
+                for i in range(count)
+            ]
             
-            client.loop_stop()
-            client.disconnect()
+            self.log(f"Publishing {count} encrypted command(s) to {data_request_topic}")
+            for encrypted_command in encrypted_commands:
+                await client.publish(data_request_topic, encrypted_command)
             
-            if received_responses:
-                encrypted_response = received_responses[0]
-                decrypted_response = self.decrypt_data(encrypted_response)
+            # Attendi risposte (più tempo per debug)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + 8.0
+            while len(responses) < count:
+                payload = await self._next_payload(incoming, deadline - loop.time())
+                if payload is None:
+                    break
                 
+                self.log(f"Received encrypted response: {len(payload)} bytes")
                 try:
-                    response_json = json.loads(decrypted_response.decode())
-                    self.log(f"Decrypted MQTT response: {response_json}", "success")
-                    self.results["mqtt_encrypted_comm"] = TestResult.SUCCESS
-                    return True
+                    response_json = _json_loads(self.decrypt_data(payload))
                 except Exception as e:
                     self.log(f"Failed to parse MQTT decrypted response: {e}", "error")
+                    continue
+                
+                key = response_json.get("id") if isinstance(response_json, dict) else None
+                responses[len(responses) if key is None else key] = response_json
+                self.log(f"Decrypted MQTT response: {response_json}", "success")
+            
+            if len(responses) >= count:
+                self.results.mqtt_encrypted_comm = TestResult.SUCCESS
+                return True
             
-            self.results["mqtt_encrypted_comm"] = TestResult.FAILED
+            self.log(f"Received {len(responses)}/{count} encrypted responses", "error")
+            self.results.mqtt_encrypted_comm = TestResult.FAILED
             return False
             
         except Exception as e:
             self.log(f"MQTT encrypted communication failed: {e}", "error")
-            self.results["mqtt_encrypted_comm"] = TestResult.FAILED
+            self.results.mqtt_encrypted_comm = TestResult.FAILED
             return False
+        finally:
+            await self._mqtt_unsubscribe(data_response_topic)
 
     # ==================== MAIN TEST RUNNER ====================
     
@@ -778,34 +952,50 @@ class Security1Tester:
         if not device_address:
             return False
         
-        # Handshake
-        handshake_success = await self.test_ble_handshake(device_address)
-        if not handshake_success:
+        # Una sola connessione (e service discovery) per handshake e comunicazione
+        try:
+            async with BleakClient(device_address) as client:
+                self._ble_client = client
+                
+                # Handshake
+                handshake_success = await self.test_ble_handshake(device_address)
+                if not handshake_success:
+                    return False
+                
+                # Encrypted communication
+                comm_success = await self.test_ble_encrypted_communication(device_address)
+        except Exception as e:
+            self.log(f"BLE connection failed: {e}", "error")
+            if self.results.ble_handshake is TestResult.PENDING:
+                self.results.ble_handshake = TestResult.FAILED
             return False
-        
-        # Encrypted communication
-        comm_success = await self.test_ble_encrypted_communication(device_address)
+        finally:
+            self._ble_client = None
         
         return handshake_success and comm_success
     
-    def run_mqtt_tests(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt", topic_prefix: str = "security1/esp32") -> bool:
+    async def run_mqtt_tests(self, broker_url: str = "ws://broker.emqx.io:8083/mqtt", topic_prefix: str = "security1/esp32", count: int = 1) -> bool:
         """Esegue tutti i test MQTT"""
         self.log("🟠 Starting MQTT Security1 tests")
         
-        # Connection
-        if not self.test_mqtt_connection(broker_url):
-            return False
-        
-        # Reset session per MQTT
-        self.session = Security1Session()
-        
-        # Handshake
-        handshake_success = self.test_mqtt_handshake(broker_url, topic_prefix)
-        if not handshake_success:
-            return False
-        
-        # Encrypted communication
-        comm_success = self.test_mqtt_encrypted_communication(broker_url, topic_prefix)
+        # Una sola connessione al broker per tutti i test MQTT
+        try:
+            # Connection
+            if not await self.test_mqtt_connection(broker_url):
+                return False
+            
+            # Reset session per MQTT (mantenendo la PoP configurata)
+            self.session = Security1Session(proof_of_possession=self.session.proof_of_possession)
+            
+            # Handshake
+            handshake_success = await self.test_mqtt_handshake(broker_url, topic_prefix)
+            if not handshake_success:
+                return False
+            
+            # Encrypted communication
+            comm_success = await self.test_mqtt_encrypted_communication(broker_url, topic_prefix, count)
+        finally:
+            await self._mqtt_close()
         
         return handshake_success and comm_success
     
@@ -815,14 +1005,17 @@ class Security1Tester:
         print("🧪 SECURITY1 TEST RESULTS")
         print("="*60)
         
-        for test_name, result in self.results.items():
-            status = result.value
-            print(f"{status} {test_name.replace('_', ' ').title()}")
+        executed = self.results.executed()
         
-        total_tests = len(self.results)
-        passed_tests = sum(1 for r in self.results.values() if r == TestResult.SUCCESS)
-        failed_tests = sum(1 for r in self.results.values() if r == TestResult.FAILED)
-        skipped_tests = sum(1 for r in self.results.values() if r == TestResult.SKIPPED)
+        for test_name, result in executed:
+            print(f"{result.value} {_RESULT_LABELS[test_name]}")
+        
+        # Conteggio per esito in un solo passaggio
+        counts = Counter(r for _, r in executed)
+        total_tests = len(executed)
+        passed_tests = counts[TestResult.SUCCESS]
+        failed_tests = counts[TestResult.FAILED]
+        skipped_tests = counts[TestResult.SKIPPED]
         
         print(f"\\n📊 Summary: {passed_tests}/{total_tests} passed, {failed_tests} failed, {skipped_tests} skipped")
         
@@ -845,6 +1038,12 @@ async def main():
                        help="Enable verbose logging")
     parser.add_argument("--pop", default="test_pop_12345",
                        help="Proof of Possession string (must match ESP32 configuration)")
+    parser.add_argument("--count", type=int, default=1,
+                       help="Encrypted MQTT commands to pipeline after the handshake")
+    parser.add_argument("--parallel", action="store_true",
+                       help="With --transport both, run BLE and MQTT suites concurrently (separate devices/sessions)")
+    parser.add_argument("--aead", action="store_true",
+                       help="Use AES-GCM for session data instead of AES-CTR + HMAC (firmware must support it)")
     
     args = parser.parse_args()
     
@@ -853,7 +1052,7 @@ async def main():
     if args.transport in ["ble", "both"] and not BLE_AVAILABLE:
         missing_deps.append("bleak")
     if args.transport in ["mqtt", "both"] and not MQTT_AVAILABLE:
-        missing_deps.append("paho-mqtt")
+        missing_deps.append("aiomqtt")
     if not CRYPTO_AVAILABLE:
         missing_deps.append("cryptography")
     
@@ -863,7 +1062,7 @@ async def main():
         return 1
     
     # Inizializza tester
-    tester = Security1Tester(verbose=args.verbose, pop=args.pop)
+    tester = Security1Tester(verbose=args.verbose, pop=args.pop, aead=args.aead)
     
     print("🚀 Starting Security1 Test Suite")
     print(f"Transport: {args.transport}")
@@ -875,6 +1074,18 @@ async def main():
     
     overall_success = True
     
+    if args.transport == "both" and args.parallel:
+        # Suite indipendenti in parallelo sullo stesso event loop: MQTT su un tester
+        # con sessione propria che scrive sugli stessi risultati
+        mqtt_tester = Security1Tester(verbose=args.verbose, pop=args.pop, aead=args.aead)
+        mqtt_tester.results = tester.results
+        ble_success, mqtt_success = await asyncio.gather(
+            tester.run_ble_tests(args.device),
+            mqtt_tester.run_mqtt_tests(args.broker, args.topic, args.count)
+        )
+        tester.print_results()
+        return 0 if ble_success and mqtt_success else 1
+    
     # Esegui test BLE
     if args.transport in ["ble", "both"]:
         ble_success = await tester.run_ble_tests(args.device)
@@ -882,7 +1093,7 @@ async def main():
     
     # Esegui test MQTT
     if args.transport in ["mqtt", "both"]:
-        mqtt_success = tester.run_mqtt_tests(args.broker, args.topic)
+        mqtt_success = await tester.run_mqtt_tests(args.broker, args.topic, args.count)
         overall_success = overall_success and mqtt_success
     
     # Stampa risultati
@@ -891,4 +1102,5 @@ async def main():
     return 0 if overall_success else 1
 
 if __name__ == "__main__":
-    exit(asyncio.run(main()))
\ No newline at end of file
+    # sys.exit e non il builtin exit() di site, assente con python -S / eseguibili congelati
+    sys.exit(asyncio.run(main()))
\ No newline at end of file
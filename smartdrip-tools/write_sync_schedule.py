@@ -6,24 +6,57 @@ Usage:
     python write_sync_schedule.py           # auto-discovers first SMART_DRIP
     python write_sync_schedule.py <MAC>     # connect to specific address
 """
-import asyncio, json, sys
+import asyncio, functools, json, struct, sys
 from bleak import BleakClient, BleakScanner
 
+try:
+    import orjson  # serializzazione JSON più veloce, opzionale
+except ImportError:
+    orjson = None
+
+try:
+    import uvloop  # event loop libuv, opzionale (non disponibile su Windows)
+except ImportError:
+    uvloop = None
+
+# Encoder JSON compatto (meno byte da spedire sull'MTU BLE), creato una sola volta
+if orjson is not None:
+    _json_bytes = orjson.dumps
+else:
+    _JSON_ENCODER = json.JSONEncoder(separators=(",", ":"))
+
+    def _json_bytes(obj) -> bytes:
+        return _JSON_ENCODER.encode(obj).encode()
+
 DEVICE_NAME   = "SMART_DRIP"
 CHAR_RX_UUID  = "0000ff01-0000-1000-8000-00805f9b34fb"   # RX characteristic (simple 16-bit UUID)
+CHAR_TX_UUID  = "0000ff02-0000-1000-8000-00805f9b34fb"   # TX characteristic (notifiche di risposta)
 
-def build_frame(request_id: int, op: str, payload: dict) -> bytes:
+@functools.lru_cache(maxsize=None)
+def _op_prefix(op: str) -> bytes:
+    """opLen + op, validato e codificato una volta per op"""
     op_bytes = op.encode()
     if len(op_bytes) > 15:
         raise ValueError("op string too long (max 15)")
-    payload_bytes = json.dumps(payload).encode()
+    return bytes((len(op_bytes),)) + op_bytes
 
-    frame = bytearray()
-    frame += request_id.to_bytes(2, "little")   # id
-    frame.append(len(op_bytes))                 # opLen
-    frame += op_bytes                           # op
-    frame += payload_bytes                      # JSON payload
-    return bytes(frame)
+def build_frame(request_id: int, op: str, payload: dict) -> bytes:
+    return (struct.pack("<H", request_id)    # id
+            + _op_prefix(op)                 # opLen + op
+            + _json_bytes(payload))          # JSON payload
+
+# Frame di test, costruito una volta all'import
+SYNC_SCHEDULE_FRAME = build_frame(
+    request_id=1,
+    op="syncSchedule",
+    payload={
+        "zones": [
+            {"id": 1, "dur": 300},
+            {"id": 2, "dur": 180}
+        ],
+        "name": "Spring"
+    }
+)
 
 async def main():
     target_addr = sys.argv[1] if len(sys.argv) == 2 else None
@@ -33,11 +66,10 @@ async def main():
         dev = await BleakScanner.find_device_by_address(target_addr, timeout=5.0)
     else:
         print("Scanning for device named", DEVICE_NAME, "…")
-        devices = await BleakScanner.discover(5.0)
-        print("Found devices:")
-        for d in devices:
-            print(f"  {d.address} - {d.name}")
-        dev = next((d for d in devices if d.name == DEVICE_NAME), None)
+        # Si ferma al primo advertising con il nome giusto
+        dev = await BleakScanner.find_device_by_filter(
+            lambda d, ad: d.name == DEVICE_NAME, timeout=5.0
+        )
 
     if dev is None:
         print("Device not found."); return
@@ -56,43 +88,48 @@ async def main():
             for char in service.characteristics:
                 print(f"    Char {char.uuid} - Properties: {char.properties}")
 
-        # Verifica che la caratteristica esista
-        char = None
-        for service in services:
-            for c in service.characteristics:
-                if str(c.uuid).lower() == CHAR_RX_UUID.lower():
-                    char = c
-                    print(f"✅ Found RX characteristic: {c.uuid}")
-                    break
-            if char:
-                break
+        # Verifica che la caratteristica esista (lookup per UUID già indicizzato da Bleak)
+        char = services.get_characteristic(CHAR_RX_UUID)
         
         if not char:
             print(f"❌ RX characteristic {CHAR_RX_UUID} not found!")
             return
+        print(f"✅ Found RX characteristic: {char.uuid}")
         
-        frame = build_frame(
-            request_id=1,
-            op="syncSchedule",
-            payload={
-                "zones": [
-                    {"id": 1, "dur": 300},
-                    {"id": 2, "dur": 180}
-                ],
-                "name": "Spring"
-            }
-        )
+        frame = SYNC_SCHEDULE_FRAME
+
+        # Facoltativo: ascolta le notifiche di risposta (caratteristica TX 0xFF02, se presente).
+        # Sottoscritte prima della write, così la risposta non può arrivare prima del listener
+        tx_char = services.get_characteristic(CHAR_TX_UUID)
+        notified = asyncio.Event()
+
+        async def on_notify(_, data): 
+            print("📨 Notification received:", data.hex())
+            notified.set()
+        if tx_char:
+            await client.start_notify(tx_char, on_notify)
+        else:
+            print(f"⚠️ TX characteristic {CHAR_TX_UUID} not found, not waiting for a reply")
         
         print(f"📝 Writing {len(frame)} bytes to characteristic {char.uuid}")
-        await client.write_gatt_char(CHAR_RX_UUID, frame, response=False)
+        await client.write_gatt_char(char, frame, response=False)
         print("✅ Frame sent successfully.")
 
-        # Facoltativo: ascolta una notifica di risposta (caratteristica TX 0xFF02)
-        async def on_notify(_, data): 
-            print("📨 Notification received:", data.hex())
-        await client.start_notify("0000ff02-0000-1000-8000-00805f9b34fb", on_notify)
-        await asyncio.sleep(3)
-        await client.stop_notify("0000ff02-0000-1000-8000-00805f9b34fb")
+        if not tx_char:
+            return
+
+        # Attende la prima notifica (max 3 s), poi resta in ascolto finché arrivano altri chunk
+        timeout = 3.0
+        try:
+            while True:
+                await asyncio.wait_for(notified.wait(), timeout)
+                notified.clear()
+                timeout = 0.3
+        except asyncio.TimeoutError:
+            pass
+        await client.stop_notify(tx_char)
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
     asyncio.run(main())